@@ -1,14 +1,63 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.templatetags.admin_urls import add_preserved_filters
+from django.contrib.admin.utils import quote, unquote
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.db import router
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.urls import NoReverseMatch, reverse
+from django.utils.text import Truncator
+from django.utils.http import urlencode
+from django.utils.translation import gettext as _
 from django_mptt_admin.admin import DjangoMpttAdmin
 from treebeard.admin import TreeAdmin
 from treebeard.forms import movenodeform_factory
 
+from category.locks import tree_lock
 from category.models import Category, CategoryMPTT, CategoryTreeBeard
 
 
+class CachedRawIdWidget(ForeignKeyRawIdWidget):
+    """``raw_id_fields`` widget labelled from ``related``, the object the form instance already holds"""
+
+    related = None
+
+    def label_and_url_for_value(self, value):
+        related = self.related
+        if related is None or str(related.pk) != str(value):
+            return super().label_and_url_for_value(value)
+        opts = related._meta
+        try:
+            url = reverse(f"{self.admin_site.name}:{opts.app_label}_{opts.model_name}_change", args=(related.pk,))
+        except NoReverseMatch:
+            url = ""
+        return Truncator(related).words(14), url
+
+
+class CategoryTreeInlineForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        widget = self.fields["parent"].widget
+        if isinstance(widget, CachedRawIdWidget):
+            # joined by CategoryTreeInline.get_queryset(), no query per form
+            widget.related = self.instance._state.fields_cache.get("parent")
+
+
 class CategoryTreeInline(admin.TabularInline):
     model = CategoryMPTT
+    form = CategoryTreeInlineForm
     extra = 1
+    # a select would render every node of every tree in each form
+    raw_id_fields = ["parent", ]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("category", "parent")
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "parent":
+            kwargs["widget"] = CachedRawIdWidget(db_field.remote_field, self.admin_site, using=kwargs.get("using"))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Category)
@@ -18,14 +67,104 @@ class CategoryAdmin(admin.ModelAdmin):
     ordering = ["name", ]
     inlines = [CategoryTreeInline, ]
 
+    def changeform_view(self, request, object_id=None, form_url="", extra_context=None):
+        # the inline nodes may add roots after children: lock the whole forest before the first
+        # write instead of upgrading the shared forest lock halfway, see category.locks
+        if request.method != "POST":
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        with tree_lock(CategoryMPTT, using=router.db_for_write(CategoryMPTT)):
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
 
 class CategoryTreeAdmin(DjangoMpttAdmin):
     list_filter = ["level", ]
-    # pass
+    list_select_related = ["category", ]
+    # selects would render every node and every category
+    raw_id_fields = ["parent", "category", ]
+    # the tree starts with the roots only, every expand loads one page of one level
+    tree_load_on_demand = 0
+    tree_page_size = 500
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("category")
+
+    def tree_json_view(self, request):
+        """
+        Children of ``?node=`` (the roots without it) as jqTree data, one level and one page
+        per request, filtered like the changelist. A level wider than ``tree_page_size`` shows
+        its first page, the other pages follow at the same level as nodes (``<parent>@<offset>``)
+        that load their page when they are expanded.
+        """
+        request.current_app = self.admin_site.name
+        parent_id, separator, offset = request.GET.get("node", "").partition("@")
+        try:
+            parent_id = int(parent_id) if parent_id else None
+            offset = int(offset or 0)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid node")
+        if parent_id is None:
+            max_level = self.tree_load_on_demand
+        else:
+            max_level = self.model._default_manager.filter(pk=parent_id).values_list("level", flat=True).first()
+            if max_level is None:
+                raise Http404
+            max_level += 1
+
+        change_list = self.get_change_list_for_tree(request, parent_id, max_level)
+        queryset = self.filter_tree_queryset(change_list.get_queryset(request), request)
+        queryset, _may_have_duplicates = self.get_search_results(
+            request, queryset.filter(parent_id=parent_id), change_list.query)
+        size = self.tree_page_size
+        page = list(queryset.select_related("category").order_by("tree_id", "lft")[offset:offset + size + 1])
+
+        filters = change_list.get_filters_params()
+        if change_list.query:
+            filters[SEARCH_VAR] = change_list.query
+        preserved_filters = urlencode({"_changelist_filters": urlencode(filters, doseq=True)})
+
+        def url(name, pk):
+            return add_preserved_filters({"preserved_filters": preserved_filters, "opts": self.opts},
+                                         self.get_admin_url(name, (quote(pk),)))
+
+        nodes = [
+            {
+                "name": str(node),
+                "id": node.pk,
+                "url": url("change", node.pk),
+                "move_url": url("move", node.pk),
+                "load_on_demand": node.child_count > 0,
+            }
+            for node in page[:size]
+        ]
+        if len(page) > size and not separator:
+            lookup = {"parent__id__exact": parent_id} if parent_id else {"parent__isnull": "True"}
+            grid_url = f"{self.get_admin_url('grid')}?{urlencode({**filters, **lookup}, doseq=True)}"
+            total = queryset.count()
+            for start in range(size, total, size):
+                page_id = f"{parent_id or ''}@{start}"
+                nodes.append({
+                    "name": _("%(first)s–%(last)s of %(total)s")
+                    % {"first": start + 1, "last": min(start + size, total), "total": total},
+                    "id": page_id,
+                    "url": grid_url,
+                    # pages cannot be moved, see move_view()
+                    "move_url": self.get_admin_url("move", (quote(page_id),)),
+                    "load_on_demand": True,
+                })
+        # a list, not a dict
+        return JsonResponse(nodes, safe=False)
+
+    def move_view(self, request, object_id):
+        if "@" in unquote(object_id) or "@" in request.POST.get("target_id", ""):
+            return HttpResponseBadRequest("Pages of the tree cannot be moved")
+        return super().move_view(request, object_id)
 
 
 class MyAdmin(TreeAdmin):
     form = movenodeform_factory(CategoryTreeBeard)
+    # treebeard already shows one level per page, skip the COUNT(*) over the whole table
+    list_per_page = 200
+    show_full_result_count = False
 
 
 admin.site.register(CategoryTreeBeard, MyAdmin)
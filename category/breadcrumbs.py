@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+
+
+class CachedNode(NamedTuple):
+    id: int
+    path: str
+    name: str
+
+
+class AncestorCache:
+    """
+    Per-process LRU cache of materialized-path nodes keyed by ``path``.
+
+    An ancestor chain is assembled from the prefixes of a node path, so a chain costs
+    one dictionary lookup per level and at most one query for the prefixes that are missing.
+    Entries are dropped by the signal handlers in ``category.signals``.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._nodes: "OrderedDict[str, CachedNode]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get_ancestors(self, node, include_self: bool = False) -> List[CachedNode]:
+        """returns the ancestors of ``node`` from the root down (and the node itself if asked)"""
+        steplen = node.steplen
+        stop = len(node.path) + (steplen if include_self else 0)
+        paths = [node.path[:end] for end in range(steplen, stop, steplen)]
+
+        chain: List[Optional[CachedNode]] = []
+        missing = []
+        with self._lock:
+            for path in paths:
+                cached = self._nodes.get(path)
+                if cached is not None:
+                    self._nodes.move_to_end(path)
+                else:
+                    missing.append(path)
+                chain.append(cached)
+
+        if missing:
+            loaded = {
+                path: CachedNode(pk, path, name)
+                for pk, path, name in type(node)._default_manager.filter(path__in=missing)
+                .order_by().values_list("pk", "path", "name")
+            }
+            with self._lock:
+                for cached in loaded.values():
+                    self._nodes[cached.path] = cached
+                while len(self._nodes) > self.maxsize:
+                    self._nodes.popitem(last=False)
+            chain = [cached or loaded.get(path) for cached, path in zip(chain, paths)]
+
+        return [cached for cached in chain if cached is not None]
+
+    def breadcrumbs(self, node, include_self: bool = True) -> List[str]:
+        """returns the names of the ancestor chain, e.g. for rendering a breadcrumb"""
+        return [cached.name for cached in self.get_ancestors(node, include_self=include_self)]
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._nodes.pop(path, None)
+
+    def invalidate_prefix(self, path: str):
+        """drops ``path`` and everything below it"""
+        with self._lock:
+            for key in [key for key in self._nodes if key.startswith(path)]:
+                del self._nodes[key]
+
+    def clear(self):
+        with self._lock:
+            self._nodes.clear()
+
+
+ancestor_cache = AncestorCache(maxsize=getattr(settings, "CATEGORY_BREADCRUMB_CACHE_SIZE", 10000))
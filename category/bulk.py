@@ -0,0 +1,131 @@
+"""
+COPY-based bulk writes for the category tables.
+
+``bulk_create`` renders an INSERT with one placeholder per value and goes through the ORM
+compiler for every batch, which dominates loads of millions of rows. ``copy_rows()`` streams
+plain rows through ``COPY ... FROM STDIN`` (text format, one in-memory buffer per batch) on
+PostgreSQL and falls back to batched ``executemany`` elsewhere; ``copy_objects()`` does the same
+for unsaved model instances. COPY returns no ids, ``allocate_ids()`` reserves them up front.
+
+Only columns of plain scalar types (numbers, booleans, texts, dates and times, UUIDs and keys
+to them) are written as COPY text. Tables with other columns (JSON, arrays, binary data, ...)
+go through ``executemany`` on PostgreSQL too, where the driver adapts the values.
+
+Like ``QuerySet.update()`` none of them calls ``save()`` or sends signals.
+"""
+import datetime
+import io
+from itertools import islice
+from typing import Iterable, List, Optional, Sequence
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+NULL = "\\N"
+
+# internal types whose database values have a plain text form in COPY
+COPY_TYPES = frozenset({
+    "AutoField", "BigAutoField", "SmallAutoField", "IntegerField", "BigIntegerField", "SmallIntegerField",
+    "PositiveIntegerField", "PositiveBigIntegerField", "PositiveSmallIntegerField", "BooleanField",
+    "DecimalField", "FloatField", "CharField", "TextField", "SlugField", "EmailField", "URLField",
+    "FilePathField", "DateField", "DateTimeField", "TimeField", "UUIDField",
+})
+
+# backslash escapes of the COPY text format
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _quoted(connection, names: Iterable[str]) -> str:
+    return ", ".join(connection.ops.quote_name(name) for name in names)
+
+
+def copy_supported(model, columns: Optional[Sequence[str]] = None) -> bool:
+    """whether the ``columns`` of ``model`` (all by default) are all of ``COPY_TYPES``"""
+    fields = {field.column: field for field in model._meta.concrete_fields}
+    for column in fields if columns is None else columns:
+        field = fields[column]
+        if field.is_relation:
+            field = field.target_field
+        if field.get_internal_type() not in COPY_TYPES:
+            return False
+    return True
+
+
+def _copy_text(value) -> str:
+    """one value in the COPY text format"""
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_rows(model, columns: Sequence[str], rows: Iterable[Sequence], batch_size: int = 10000,
+              using: Optional[str] = None) -> int:
+    """
+    Inserts ``rows`` (tuples of database values in the order of the ``columns`` names) into the
+    table of ``model`` and returns their number. ``rows`` may be a generator, at most
+    ``batch_size`` rows are held in memory.
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    table = connection.ops.quote_name(model._meta.db_table)
+    copy = connection.vendor == "postgresql" and copy_supported(model, columns)
+    rows = iter(rows)
+    count = 0
+    with connection.cursor() as cursor:
+        while batch := list(islice(rows, batch_size)):
+            if copy:
+                buffer = io.StringIO()
+                buffer.writelines("\t".join(map(_copy_text, row)) + "\n" for row in batch)
+                buffer.seek(0)
+                cursor.cursor.copy_expert(f"COPY {table} ({_quoted(connection, columns)}) FROM STDIN", buffer)
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {table} ({_quoted(connection, columns)}) "
+                    f"VALUES ({', '.join(['%s'] * len(columns))})", batch)
+            count += len(batch)
+    return count
+
+
+def copy_objects(model, objs: Iterable, fields: Optional[Sequence[str]] = None, raw: bool = False,
+                 batch_size: int = 10000, using: Optional[str] = None) -> int:
+    """
+    ``bulk_create()`` through ``copy_rows()``: writes ``fields`` (all concrete fields by default)
+    of ``objs``, which need their primary keys set, see ``allocate_ids()``. Without ``raw``
+    the values go through ``pre_save()`` like an insert (``auto_now`` fields are stamped),
+    with it they are written as they are, like ``loaddata`` does.
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    opts = model._meta
+    fields = opts.concrete_fields if fields is None else [opts.get_field(name) for name in fields]
+
+    def values(obj):
+        if obj.pk is None:
+            raise ValueError(f"{obj!r} has no primary key, copy_objects() cannot return one")
+        return tuple(
+            field.get_db_prep_save(getattr(obj, field.attname) if raw else field.pre_save(obj, True), connection)
+            for field in fields
+        )
+
+    return copy_rows(model, [field.column for field in fields], map(values, objs), batch_size, using)
+
+
+def allocate_ids(model, count: int, using: Optional[str] = None) -> List[int]:
+    """
+    Reserves ``count`` primary keys of ``model``: from its sequence on PostgreSQL, after the
+    current maximum elsewhere, where the caller must keep other writers out (``tree_lock()``).
+    """
+    if count <= 0:
+        return []
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    table = model._meta.db_table
+    column = model._meta.pk.column
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                           [connection.ops.quote_name(table), column, count])
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute(f"SELECT MAX({connection.ops.quote_name(column)}) FROM {connection.ops.quote_name(table)}")
+        first = (cursor.fetchone()[0] or 0) + 1
+    return list(range(first, first + count))
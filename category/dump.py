@@ -0,0 +1,96 @@
+import json
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+from category.instrumentation import traced
+from category.models import CategoryMPTT, CategoryTreeBeard
+
+# output key -> lookup, a plain sequence uses the lookups as keys
+Fields = Union[Sequence[str], Mapping[str, str]]
+
+DEFAULT_FIELDS = {
+    CategoryMPTT: {"category_id": "category_id", "name": "name"},
+    CategoryTreeBeard: {"name": "name"},
+}
+
+
+def _fields(model, fields: Optional[Fields]) -> Dict[str, str]:
+    if fields is None:
+        return DEFAULT_FIELDS[model]
+    if isinstance(fields, Mapping):
+        return dict(fields)
+    return {field: field for field in fields}
+
+
+def _tree_queryset(model, root, max_depth: Optional[int]):
+    """the subtree in DFS order plus the name of its depth column"""
+    if model is CategoryMPTT:
+        if root is None:
+            queryset, base = model.objects.all(), 0
+        else:
+            queryset, base = root.get_descendants(include_self=True), root.level
+        if max_depth is not None:
+            queryset = queryset.filter(level__lte=base + max_depth)
+        return queryset.order_by("tree_id", "lft"), "level"
+
+    queryset = model.objects.get_tree(root, max_depth=max_depth)
+    if root is None and max_depth is not None:
+        # treebeard counts the roots as depth 1
+        queryset = queryset.filter(depth__lte=max_depth + 1)
+    return queryset.order_by("path"), "depth"
+
+
+def tree_rows(root=None, fields: Optional[Fields] = None, max_depth: Optional[int] = None,
+              model=None, chunk_size: int = 2000) -> Iterator[Tuple[int, dict]]:
+    """
+    Yields ``(depth, node)`` in DFS order from a single query.
+
+    ``fields`` may span relations (``category__name``), the join happens in the same query.
+    """
+    model = model or (type(root) if root is not None else CategoryMPTT)
+    fields = _fields(model, fields)
+    queryset, depth_field = _tree_queryset(model, root, max_depth)
+
+    plain = [lookup for key, lookup in fields.items() if key == lookup]
+    aliased = {key: lookup for key, lookup in fields.items() if key != lookup}
+    columns = ["id", depth_field, *plain, *aliased.values()]
+    keys = ["id", *plain, *aliased]
+    for row in queryset.values_list(*columns).iterator(chunk_size=chunk_size):
+        yield row[1], dict(zip(keys, row[:1] + row[2:]))
+
+
+@traced("dump_tree")
+def dump_tree(root=None, fields: Optional[Fields] = None, max_depth: Optional[int] = None, model=None) -> List[dict]:
+    """
+    Returns the (sub)tree as nested dicts ``{"id": ..., <fields>, "children": [...]}``.
+
+    One query for the whole tree, the nesting is built in a single linear pass.
+    Without ``root`` the whole forest of ``model`` (CategoryMPTT by default) is dumped.
+    """
+    forest: List[dict] = []
+    stack: List[Tuple[int, dict]] = []
+    for depth, node in tree_rows(root, fields, max_depth, model):
+        node["children"] = []
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        (stack[-1][1]["children"] if stack else forest).append(node)
+        stack.append((depth, node))
+    return forest
+
+
+def iter_tree_json(root=None, fields: Optional[Fields] = None, max_depth: Optional[int] = None,
+                   model=None) -> Iterator[str]:
+    """
+    Streams the same structure as ``dump_tree`` as JSON text without building it in memory.
+    """
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    depths: List[int] = []
+    yield "["
+    for depth, node in tree_rows(root, fields, max_depth, model):
+        closing = ""
+        while depths and depths[-1] >= depth:
+            depths.pop()
+            closing += "]}"
+        # closing a node means the next one is its sibling (or the next root)
+        yield closing + ("," if closing else "") + encode(node)[:-1] + ',"children":['
+        depths.append(depth)
+    yield "]}" * len(depths) + "]"
@@ -0,0 +1,92 @@
+"""
+Opt-in identity map for ``GetOrNoneManager`` lookups.
+
+Inside ``identity_map()``, or a request handled by ``IdentityMapMiddleware``, ``get_or_none()``
+and ``get_many_or_none()`` hand out the instance already loaded for the same ``field=value``
+instead of querying again. Saves and deletes drop the instance (see ``category.signals``), so a
+renamed object is never found under its old name. Misses are not remembered: an object created
+later in the same block is found by the next lookup.
+
+    with identity_map():
+        for row in rows:
+            category = Category.objects.get_or_none(name=row["category"])  # one query per name
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+Key = Tuple[str, str, Hashable]
+
+
+class IdentityMap:
+    def __init__(self):
+        self._entries: Dict[Key, Any] = {}
+        # (model, pk) -> keys of the instance, to drop it on save or delete
+        self._keys: Dict[Tuple[str, Any], Set[Key]] = defaultdict(set)
+
+    @staticmethod
+    def _key(model, attname: str, value) -> Key:
+        return model._meta.label_lower, attname, value
+
+    def get(self, model, attname: str, value):
+        return self._entries.get(self._key(model, attname, value))
+
+    def add(self, instance, attname: str):
+        model = type(instance)
+        for key in (self._key(model, attname, getattr(instance, attname)),
+                    self._key(model, model._meta.pk.attname, instance.pk)):
+            self._entries[key] = instance
+            self._keys[model._meta.label_lower, instance.pk].add(key)
+
+    def discard(self, instance):
+        for key in self._keys.pop((type(instance)._meta.label_lower, instance.pk), ()):
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_current: ContextVar[Optional[IdentityMap]] = ContextVar("category_identity_map", default=None)
+
+
+def current_identity_map() -> Optional[IdentityMap]:
+    return _current.get()
+
+
+@contextmanager
+def identity_map():
+    """activates an identity map for the enclosed block, nested blocks share the outer one"""
+    active = _current.get()
+    if active is not None:
+        yield active
+        return
+    token = _current.set(IdentityMap())
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+class IdentityMapMiddleware:
+    """one identity map per request"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with identity_map():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with identity_map():
+            return await self.get_response(request)
@@ -0,0 +1,295 @@
+"""
+Lightweight, production-safe metrics for tree operations.
+
+``measure()`` counts the queries and SQL time of everything executed inside it, ``tree_span()``
+attributes time and queries to named tree operations (``mptt.insert``, ``treebeard.move``, ...).
+``TreeMetricsMiddleware`` wraps every request (and the body of streaming responses) in
+``measure()`` and hands the report to the sink configured in ``settings.CATEGORY_METRICS``::
+
+    CATEGORY_METRICS = {
+        "SINK": "category.instrumentation.StatsdSink",
+        "OPTIONS": {"host": "127.0.0.1", "port": 8125, "prefix": "catalog"},
+    }
+"""
+import functools
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("calls", "seconds", "queries")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+
+    def as_dict(self) -> dict:
+        return {"calls": self.calls, "seconds": self.seconds, "queries": self.queries}
+
+
+class Metrics:
+    """query counters and spans collected inside one ``measure()`` block"""
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.status: Optional[int] = None
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.seconds = 0.0
+        self.spans: Dict[str, Span] = {}
+
+    def as_dict(self) -> dict:
+        return {
+            "label": self.label,
+            "status": self.status,
+            "queries": self.queries,
+            "sql_seconds": self.sql_seconds,
+            "seconds": self.seconds,
+            "spans": {name: span.as_dict() for name, span in self.spans.items()},
+        }
+
+
+_current: ContextVar[Optional[Metrics]] = ContextVar("category_metrics", default=None)
+
+
+def current_metrics() -> Optional[Metrics]:
+    return _current.get()
+
+
+def _query_counter(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.sql_seconds += time.perf_counter() - started
+
+
+def install_query_counter(connection, **kwargs):
+    """
+    Adds the query counter to ``connection`` for good. It costs one ContextVar lookup per query
+    outside ``measure()``; being permanent it also counts the queries of async views, which run
+    on the connections of ``sync_to_async`` threads (asgiref carries the ContextVar over).
+    """
+    if _query_counter not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_query_counter)
+
+
+connection_created.connect(install_query_counter, dispatch_uid="category.instrumentation.query_counter")
+
+
+@contextmanager
+def measure(label: str = ""):
+    """collects query counts, SQL time and spans of the enclosed block, in every thread it spans"""
+    metrics = Metrics(label)
+    # connections opened before this module was imported never sent connection_created
+    for connection in connections.all(initialized_only=True):
+        install_query_counter(connection)
+    token = _current.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.seconds = time.perf_counter() - started
+        _current.reset(token)
+
+
+@contextmanager
+def tree_span(name: str):
+    """attributes time and queries of the enclosed block to ``name``, a no-op outside ``measure()``"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    queries = metrics.queries
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        span = metrics.spans.get(name)
+        if span is None:
+            span = metrics.spans[name] = Span()
+        span.calls += 1
+        span.seconds += time.perf_counter() - started
+        span.queries += metrics.queries - queries
+
+
+def traced(name: str):
+    """decorator form of ``tree_span``"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tree_span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class LogSink:
+    """writes one log line per report"""
+
+    def __init__(self, logger_name: str = __name__, level: int = logging.INFO):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+
+    def emit(self, metrics: Metrics):
+        spans = " ".join(
+            f"{name}={span.calls}x/{span.seconds * 1000:.1f}ms/{span.queries}q"
+            for name, span in metrics.spans.items()
+        )
+        self.logger.log(self.level, "%s status=%s queries=%d sql=%.1fms total=%.1fms %s",
+                        metrics.label, metrics.status, metrics.queries, metrics.sql_seconds * 1000,
+                        metrics.seconds * 1000, spans)
+
+
+class StatsdSink:
+    """sends StatsD counters and timers over UDP, never blocks or raises on the request path"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8125, prefix: str = "category"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def lines(self, metrics: Metrics) -> List[str]:
+        prefix = self.prefix
+        lines = [
+            f"{prefix}.request.queries:{metrics.queries}|h",
+            f"{prefix}.request.sql:{metrics.sql_seconds * 1000:.3f}|ms",
+            f"{prefix}.request.time:{metrics.seconds * 1000:.3f}|ms",
+        ]
+        for name, span in metrics.spans.items():
+            lines += [
+                f"{prefix}.{name}.calls:{span.calls}|c",
+                f"{prefix}.{name}.time:{span.seconds * 1000:.3f}|ms",
+                f"{prefix}.{name}.queries:{span.queries}|h",
+            ]
+        return lines
+
+    def emit(self, metrics: Metrics):
+        try:
+            self.socket.sendto("\n".join(self.lines(metrics)).encode(), self.address)
+        except OSError:
+            logger.debug("StatsD packet dropped", exc_info=True)
+
+
+class RingBufferSink:
+    """keeps the last ``size`` reports in memory"""
+
+    def __init__(self, size: int = 1000):
+        self.reports: Deque[dict] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def emit(self, metrics: Metrics):
+        with self._lock:
+            self.reports.append(metrics.as_dict())
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            return list(self.reports)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sink():
+    config = getattr(settings, "CATEGORY_METRICS", {})
+    sink_class = import_string(config.get("SINK", "category.instrumentation.LogSink"))
+    return sink_class(**config.get("OPTIONS", {}))
+
+
+class TreeMetricsMiddleware:
+    """
+    reports queries, SQL time and tree spans of every request to the configured sink, the
+    report of a streaming response follows its last chunk
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sink = get_sink()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with measure(f"{request.method} {request.path}") as metrics:
+            response = self.get_response(request)
+            metrics.status = response.status_code
+        return self._report(metrics, response)
+
+    async def __acall__(self, request):
+        with measure(f"{request.method} {request.path}") as metrics:
+            response = await self.get_response(request)
+            metrics.status = response.status_code
+        return self._report(metrics, response)
+
+    def _report(self, metrics: Metrics, response):
+        if not response.streaming:
+            self.sink.emit(metrics)
+        elif response.is_async:
+            response.streaming_content = self._ameasure_chunks(metrics, response.streaming_content)
+        else:
+            response.streaming_content = self._measure_chunks(metrics, response.streaming_content)
+        return response
+
+    def _measure_chunks(self, metrics: Metrics, chunks):
+        """
+        the body is produced after the middleware returned, in the server's context: each chunk
+        is measured on its own, the report is emitted after the last one (or a disconnect)
+        """
+        started = time.perf_counter() - metrics.seconds
+        chunks = iter(chunks)
+        try:
+            while True:
+                token = _current.set(metrics)
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    _current.reset(token)
+                yield chunk
+        finally:
+            metrics.seconds = time.perf_counter() - started
+            self.sink.emit(metrics)
+
+    async def _ameasure_chunks(self, metrics: Metrics, chunks):
+        """``_measure_chunks()`` of an async streaming response"""
+        started = time.perf_counter() - metrics.seconds
+        chunks = aiter(chunks)
+        try:
+            while True:
+                token = _current.set(metrics)
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    _current.reset(token)
+                yield chunk
+        finally:
+            metrics.seconds = time.perf_counter() - started
+            self.sink.emit(metrics)
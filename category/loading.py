@@ -0,0 +1,256 @@
+"""
+Streaming fixture loader.
+
+``loaddata`` parses a whole fixture into memory and saves its objects one at a time.
+``load_fixture()`` reads ``dumpdata`` JSON arrays and JSON Lines incrementally, buffers the
+deserialized objects per model and writes them in batches, so memory is bounded by
+``batch_size`` per model instead of the fixture size. New rows of tables with plain scalar
+columns are streamed with ``category.bulk.copy_objects()`` (COPY on PostgreSQL); rows whose
+primary key already exists, rows without one and rows of tables with other columns (JSON,
+arrays, ...) go through ``bulk_create``. Like ``loaddata`` it runs in one
+transaction with deferred constraint checks (the order of the objects does not matter),
+overwrites rows with the same primary key and resets the sequences afterwards.
+
+Neither calls ``save()`` or sends the model signals, so the tree models are finished in
+bulk at the end: ``CategoryMPTT`` rows keep their ``lft``/``rgt`` from the fixture, their names
+are synced, trees that do not check out are repaired, the counters of the loaded trees are
+recomputed (fixtures may lack them), the closure is rebuilt and the tree versions and caches are
+invalidated.
+"""
+import bz2
+import gzip
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Set, TextIO, Union
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.serializers.base import DeserializationError, DeserializedObject, M2MDeserializationError
+from django.core.serializers.python import Deserializer
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+
+from category.breadcrumbs import ancestor_cache
+from category.bulk import copy_objects, copy_supported
+from category.instrumentation import traced
+from category.models import CategoryClosure, CategoryMPTT, CategoryTreeBeard
+from category.versioning import bump_tree_version
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = " \t\r\n"
+
+
+def iter_fixture(fp: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    """
+    Yields the objects of a JSON array or of JSON Lines from ``fp`` without reading it whole.
+    Only the current object and one chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        # grows with the pending text, an object spanning many chunks is not re-parsed per chunk
+        chunk = fp.read(max(chunk_size, len(buffer) - pos))
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+
+    def skip(characters: str):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in characters:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            read_more()
+
+    skip(_WHITESPACE)
+    in_array = buffer.startswith("[", pos)
+    pos += in_array
+    separators = _WHITESPACE + ("," if in_array else "")
+    while True:
+        skip(separators)
+        if pos == len(buffer):
+            if in_array:
+                raise json.JSONDecodeError("Unterminated array", buffer, pos)
+            return
+        if in_array and buffer[pos] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # the object continues in the next chunk
+            read_more()
+            continue
+        if end == len(buffer) and not eof and not isinstance(obj, (dict, list)):
+            # a scalar at the end of the buffer may be cut off, e.g. a number
+            read_more()
+            continue
+        pos = end
+        yield obj
+
+
+@contextmanager
+def open_fixture(path: str) -> Iterator[TextIO]:
+    """opens a fixture for ``iter_fixture()``, ``.gz`` and ``.bz2`` files are decompressed on the fly"""
+    opener = {"gz": gzip.open, "bz2": bz2.open}.get(path.rsplit(".", 1)[-1], open)
+    with opener(path, "rt", encoding="utf-8") as fp:
+        yield fp
+
+
+class _Batches:
+    """per model buffers of deserialized objects, flushed with ``copy_objects`` or ``bulk_create``"""
+
+    def __init__(self, batch_size: int, using: str):
+        self.batch_size = batch_size
+        self.using = using
+        self.connection = connections[using]
+        self.pending: Dict[type, List[DeserializedObject]] = defaultdict(list)
+        self.models: Set[type] = set()
+        # trees of the loaded CategoryMPTT rows, their counters are recomputed
+        self.tree_ids: Set[int] = set()
+        self.count = 0
+
+    def add(self, deserialized: DeserializedObject):
+        model = type(deserialized.object)
+        if not router.allow_migrate_model(self.using, model):
+            return
+        if model._meta.parents:
+            # bulk_create cannot write multi-table inheritance, save like loaddata does
+            deserialized.save(using=self.using)
+            self._added(model, [deserialized])
+            return
+        batch = self.pending[model]
+        batch.append(deserialized)
+        if len(batch) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model):
+        batch = self.pending.pop(model, [])
+        if not batch:
+            return
+        objs = [deserialized.object for deserialized in batch]
+        manager = model._base_manager.db_manager(self.using)
+        if copy_supported(model) and all(obj.pk is not None for obj in objs):
+            existing = set(manager.filter(pk__in=[obj.pk for obj in objs]).values_list("pk", flat=True))
+            # new rows are copied as they are, timestamps included
+            copy_objects(model, [obj for obj in objs if obj.pk not in existing], raw=True,
+                         batch_size=self.batch_size, using=self.using)
+            objs = [obj for obj in objs if obj.pk in existing]
+        if objs:
+            self._bulk_create(manager, objs)
+        for deserialized in batch:
+            for name, values in (deserialized.m2m_data or {}).items():
+                getattr(deserialized.object, name).set(values)
+        self._added(model, batch)
+
+    def _bulk_create(self, manager, objs):
+        model = manager.model
+        if self.connection.features.supports_update_conflicts_with_target and all(obj.pk is not None for obj in objs):
+            # rows already in the database are overwritten, as loaddata does
+            update_fields = [field.name for field in model._meta.local_concrete_fields if not field.primary_key]
+            manager.bulk_create(objs, update_conflicts=bool(update_fields),
+                                unique_fields=[model._meta.pk.name] if update_fields else None,
+                                update_fields=update_fields or None)
+        else:
+            manager.bulk_create(objs)
+
+    def flush_all(self):
+        for model in list(self.pending):
+            self.flush(model)
+
+    def _added(self, model, batch: List[DeserializedObject]):
+        self.models.add(model)
+        self.count += len(batch)
+        if model is CategoryMPTT:
+            self.tree_ids.update(deserialized.object.tree_id for deserialized in batch)
+
+
+def finish_trees(models: Set[type], tree_ids: Iterable[int] = ()):
+    """
+    Brings the tree models in ``models`` up to date after rows were written around ``save()``:
+    synced names, repaired nested sets, counters of the repaired trees and of ``tree_ids``,
+    closure, new tree versions.
+    """
+    if CategoryMPTT in models:
+        CategoryMPTT.objects.sync_names()
+        tree_ids = set(tree_ids)
+        broken = CategoryMPTT.objects.check_trees()
+        if broken:
+            tree_ids.update(CategoryMPTT.objects.repair_trees(sorted(broken)))
+        if tree_ids:
+            call_command("rebuild_counts", tree_ids=sorted(tree_ids), verbosity=0)
+        if CategoryClosure.enabled():
+            CategoryClosure.objects.rebuild()
+        bump_tree_version(CategoryMPTT)
+    if CategoryTreeBeard in models:
+        ancestor_cache.clear()
+        bump_tree_version(CategoryTreeBeard)
+
+
+def _deserialize(objects: Iterable[dict], batches: _Batches, using: str, ignorenonexistent: bool):
+    """
+    Feeds ``objects`` to ``batches``. A natural key that is not in the database may belong to
+    an object that is still buffered: the batches are then flushed and the object is retried.
+    """
+    pending = iter(objects)
+    current = None
+
+    def stream():
+        nonlocal current
+        for current in pending:
+            yield current
+
+    while True:
+        try:
+            for deserialized in Deserializer(stream(), using=using, ignorenonexistent=ignorenonexistent):
+                batches.add(deserialized)
+            return
+        except DeserializationError as e:
+            cause = e.__context__
+            if isinstance(cause, M2MDeserializationError):
+                cause = cause.original_exc
+            if not isinstance(cause, ObjectDoesNotExist) or not batches.pending:
+                raise
+            batches.flush_all()
+            pending = chain([current], pending)
+
+
+@traced("load_fixture")
+def load_fixture(objects: Union[str, TextIO, Iterable[dict]], batch_size: int = 1000,
+                 using: str = DEFAULT_DB_ALIAS, ignorenonexistent: bool = False) -> int:
+    """
+    Loads a fixture (a path, an open text file or already parsed objects) and returns the
+    number of written objects.
+
+    Natural keys are resolved while reading, against the database and the objects read so far;
+    forward references to objects further down the fixture are not supported. Overwritten rows
+    get the load time in their ``auto_now`` and ``auto_now_add`` fields, as with every
+    ``bulk_create``; new rows keep the fixture's.
+    """
+    if isinstance(objects, str):
+        with open_fixture(objects) as fp:
+            return load_fixture(fp, batch_size, using, ignorenonexistent)
+    if hasattr(objects, "read"):
+        objects = iter_fixture(objects)
+
+    connection = connections[using]
+    batches = _Batches(batch_size, using)
+    with transaction.atomic(using=using):
+        with connection.constraint_checks_disabled():
+            _deserialize(objects, batches, using, ignorenonexistent)
+            batches.flush_all()
+        if not batches.count:
+            return 0
+        connection.check_constraints(table_names=[model._meta.db_table for model in batches.models])
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(), list(batches.models))
+        if sequence_sql:
+            with connection.cursor() as cursor:
+                for sql in sequence_sql:
+                    cursor.execute(sql)
+        finish_trees(batches.models, batches.tree_ids)
+    return batches.count
@@ -0,0 +1,147 @@
+"""
+Per-tree write locks for nested sets.
+
+Inserting, moving or deleting a CategoryMPTT node shifts ``lft``/``rgt`` of its whole tree, so
+two writers in the same tree must not interleave, while writers in different trees can run in
+parallel. ``tree_lock()`` opens a transaction and, on PostgreSQL, takes transaction-level
+advisory locks:
+
+* a shared lock on the *forest* plus an exclusive lock per touched ``tree_id`` for writes that
+  stay inside existing trees,
+* an exclusive lock on the forest for writes that allocate or renumber ``tree_id`` (new roots,
+  moves to and from the root level, bulk loads, repairs).
+
+One ``tree_lock()`` takes its locks in a fixed order (forest first, then ascending tree ids)
+and they are released by the commit or rollback. Writers that lock once per transaction cannot
+deadlock each other (short of the rare retry of ``tree_lock()`` after a move between trees),
+but the locks of nested blocks add up: a transaction that writes inside a
+tree (shared forest lock) and then adds a root (exclusive forest lock) has to upgrade, and two
+such transactions wait for each other. PostgreSQL aborts one of them with a deadlock error,
+which rolls the whole transaction back. Transactions that may write several trees or create
+roots after other tree writes, like the category form with its inline nodes, therefore take
+``tree_lock(model)`` of the whole forest up front; the nested locks are then free.
+
+Other databases (SQLite has a single writer anyway) get one exclusive file lock per database
+instead, the equivalent of ``BEGIN IMMEDIATE``, which cannot be upgraded. It is held until the
+outermost ``tree_lock()`` block has committed; call it outside of other transactions to cover
+them as well.
+"""
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Union
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows, only the process-local lock below
+    fcntl = None
+
+FOREST = 0  # advisory key of the forest, tree ids start at 1
+
+TreeIds = Union[Iterable[int], Callable[[], Iterable[int]]]
+
+
+def _namespace(model) -> int:
+    """a stable signed 32-bit advisory lock namespace per model"""
+    crc = zlib.crc32(model._meta.label_lower.encode())
+    return crc - (1 << 32) if crc >= 1 << 31 else crc
+
+
+class _FileLock:
+    """exclusive ``flock`` on one file, reentrant within a thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._process_lock = threading.RLock()
+
+    def acquire(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._process_lock.acquire()
+            if fcntl is not None:
+                self._local.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._local.fd, fcntl.LOCK_EX)
+        self._local.depth = depth + 1
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._local.fd, fcntl.LOCK_UN)
+                os.close(self._local.fd)
+            self._process_lock.release()
+
+
+_file_locks: Dict[str, _FileLock] = {}
+_file_locks_guard = threading.Lock()
+
+
+def _file_lock(using: str) -> _FileLock:
+    name = str(connections[using].settings_dict["NAME"])
+    directory = getattr(settings, "CATEGORY_TREE_LOCK_DIR", None) or tempfile.gettempdir()
+    path = os.path.join(directory, f"category-tree-{hashlib.sha1(name.encode()).hexdigest()[:16]}.lock")
+    with _file_locks_guard:
+        if path not in _file_locks:
+            _file_locks[path] = _FileLock(path)
+        return _file_locks[path]
+
+
+@contextmanager
+def tree_lock(model, tree_ids: Optional[TreeIds] = None, using: Optional[str] = None):
+    """
+    Runs the block in a transaction that holds the write locks of ``tree_ids`` of ``model``.
+
+    ``tree_ids`` may be a callable, it is then evaluated once the forest is locked and again
+    after the trees are locked: a move between trees that committed while the caller waited
+    changes the tree of its nodes, the new trees are locked as well until the ids are stable.
+    ``None`` locks the whole forest.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        lock = _file_lock(using)
+        lock.acquire()
+        try:
+            with transaction.atomic(using=using):
+                yield
+        finally:
+            lock.release()
+        return
+
+    namespace = _namespace(model)
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            if tree_ids is None:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [namespace, FOREST])
+            else:
+                cursor.execute("SELECT pg_advisory_xact_lock_shared(%s, %s)", [namespace, FOREST])
+                locked = set()
+                while True:
+                    wanted = set(tree_ids() if callable(tree_ids) else tree_ids)
+                    if wanted <= locked:
+                        break
+                    for tree_id in sorted(wanted - locked):
+                        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [namespace, tree_id])
+                    locked |= wanted
+                    if not callable(tree_ids):
+                        break
+        yield
+
+
+def locks_forest(method):
+    """runs a manager method under ``tree_lock()`` of the whole forest"""
+
+    @functools.wraps(method)
+    def wrapper(manager, *args, **kwargs):
+        with tree_lock(manager.model, using=manager.db):
+            return method(manager, *args, **kwargs)
+
+    return wrapper
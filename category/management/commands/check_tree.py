@@ -0,0 +1,44 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from category.models import CategoryClosure, CategoryMPTT
+
+
+class Command(BaseCommand):
+    """Validates the CategoryMPTT nested sets and repairs only the broken trees.
+
+    The check is a single query; the repair renumbers the broken trees from their parent
+    links and refreshes the denormalized counters (and the closure table, when enabled)
+    of just those trees, the rest of the table is never written.
+    """
+
+    help = "Checks the CategoryMPTT nested sets and repairs the broken trees."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only report the broken trees")
+
+    def handle(self, *args, **options):
+        verbosity = options["verbosity"]
+        broken = CategoryMPTT.objects.check_trees()
+        if not broken:
+            if verbosity > 0:
+                self.stdout.write(self.style.SUCCESS("All trees are consistent."))
+            return
+
+        tree_ids = sorted(broken)
+        for tree_id in tree_ids:
+            self.stdout.write(f"tree {tree_id}: {broken[tree_id]} inconsistent nodes")
+        if options["dry_run"]:
+            return
+
+        try:
+            # extra roots of a tree may have been moved to new trees
+            tree_ids = CategoryMPTT.objects.repair_trees(tree_ids)
+        except ValueError as exc:
+            # cyclic or orphaned parent links, nothing was written
+            raise CommandError(f"Cannot repair trees {', '.join(map(str, tree_ids))}: {exc}")
+        call_command("rebuild_counts", tree_ids=tree_ids, verbosity=0)
+        if CategoryClosure.enabled():
+            CategoryClosure.objects.rebuild(tree_ids=tree_ids)
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(f"Repaired trees: {', '.join(map(str, tree_ids))}."))
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from category.models import CategoryTreeBeard
+
+
+class Command(BaseCommand):
+    """Mirrors CategoryTreeBeard.path into a GiST-indexed ltree column (PostgreSQL only).
+
+    The column is generated from ``path``, so every write (including treebeard's raw path
+    updates on moves) keeps it in sync without triggers. The queries switch over once
+    ``CATEGORY_TREEBEARD_LTREE`` is set.
+    """
+
+    help = "Adds (or with --drop removes) the ltree mirror of CategoryTreeBeard.path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drop", action="store_true", help="remove the column and its index")
+
+    @staticmethod
+    def statements(drop: bool = False):
+        quote = connection.ops.quote_name
+        table = CategoryTreeBeard._meta.db_table
+        column = CategoryTreeBeard.objects.ltree_column
+        index = quote(f"{table}_{column}_gist")
+        if drop:
+            return [
+                f"DROP INDEX IF EXISTS {index}",
+                f"ALTER TABLE {quote(table)} DROP COLUMN IF EXISTS {quote(column)}",
+            ]
+        # one label per step: '(.{4})(?!$)' -> '\1.'
+        pattern = f"(.{{{CategoryTreeBeard.steplen}}})(?!$)"
+        return [
+            "CREATE EXTENSION IF NOT EXISTS ltree",
+            f"ALTER TABLE {quote(table)} ADD COLUMN IF NOT EXISTS {quote(column)} ltree "
+            f"GENERATED ALWAYS AS (text2ltree(regexp_replace(path, '{pattern}', '\\1.', 'g'))) STORED",
+            f"CREATE INDEX IF NOT EXISTS {index} ON {quote(table)} USING GIST ({quote(column)})",
+        ]
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError(f"ltree needs PostgreSQL, the database is {connection.vendor}.")
+        with transaction.atomic(), connection.cursor() as cursor:
+            for sql in self.statements(options["drop"]):
+                cursor.execute(sql)
+
+        if options["verbosity"] > 0:
+            action = "removed" if options["drop"] else "added"
+            self.stdout.write(self.style.SUCCESS(f"ltree mirror {action}."))
+            if not options["drop"] and not getattr(settings, "CATEGORY_TREEBEARD_LTREE", False):
+                self.stdout.write(self.style.WARNING("Set CATEGORY_TREEBEARD_LTREE to use it."))
@@ -0,0 +1,115 @@
+import csv
+import gzip
+import json
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, TextIO, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DataError, IntegrityError
+
+from category.models import Category
+
+FORMATS = ("csv", "jsonl", "text")
+
+
+class Command(BaseCommand):
+    """Idempotently imports category names from a CSV, JSON Lines or plain text file.
+
+    The file is streamed, so its size does not matter: names are deduplicated in memory and
+    upserted in batches by ``Category.objects.bulk_upsert``. Files ending in ``.gz`` are
+    decompressed on the fly, ``-`` reads standard input.
+    """
+
+    help = "Imports category names (CSV, JSON Lines or one name per line)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="input file, '-' for stdin")
+        parser.add_argument("--format", choices=FORMATS, help="default: guessed from the file extension")
+        parser.add_argument("--field", default="name",
+                            help="CSV column or JSON key holding the name (default: name)")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    @staticmethod
+    def guess_format(path: str) -> str:
+        suffix = path.removesuffix(".gz").rsplit(".", 1)[-1].lower()
+        if suffix == "csv":
+            return "csv"
+        if suffix in ("jsonl", "ndjson"):
+            return "jsonl"
+        return "text"
+
+    @contextmanager
+    def _open(self, path: str) -> Iterator[TextIO]:
+        if path == "-":
+            yield sys.stdin
+        elif path.endswith(".gz"):
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as fp:
+                yield fp
+        else:
+            with open(path, encoding="utf-8", newline="") as fp:
+                yield fp
+
+    @staticmethod
+    def read_names(fp: TextIO, file_format: str, field: str) -> Iterator[Tuple[int, str]]:
+        """``(line number, name)`` of every non-empty name, names that do not fit are rejected"""
+        if file_format == "csv":
+            reader = csv.DictReader(fp)
+            if reader.fieldnames and field not in reader.fieldnames:
+                raise CommandError(f"CSV has no '{field}' column: {reader.fieldnames}")
+            rows = ((reader.line_num, row[field] or "") for row in reader)
+        elif file_format == "jsonl":
+            rows = Command.read_records(fp, field)
+        else:
+            rows = enumerate(fp, 1)
+        max_length = Category._meta.get_field("name").max_length
+        for number, name in rows:
+            name = name.strip()
+            if len(name) > max_length:
+                raise ValueError(f"line {number}: name longer than {max_length} characters")
+            if name:
+                yield number, name
+
+    @staticmethod
+    def read_records(fp: TextIO, field: str) -> Iterator[Tuple[int, str]]:
+        """
+        ``(line number, name)`` of JSON Lines records, either strings or objects with the name
+        in ``field``
+        """
+        for number, line in enumerate(fp, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                if field not in record:
+                    raise ValueError(f"line {number}: no '{field}' key in {line.strip()}")
+                record = record[field]
+            if not isinstance(record, str):
+                raise ValueError(f"line {number}: expected a string or an object with a string '{field}', "
+                                 f"got {line.strip()}")
+            yield number, record
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or self.guess_format(path)
+        started = time.perf_counter()
+        line = 0
+
+        def names(fp):
+            nonlocal line
+            for line, name in self.read_names(fp, file_format, options["field"]):
+                yield name
+
+        try:
+            with self._open(path) as fp:
+                ids = Category.objects.bulk_upsert(names(fp), batch_size=options["batch_size"])
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Cannot import {path}: {exc!r}")
+        except (DataError, IntegrityError) as exc:
+            # a batch is written right after its last name was read, the batches before it are kept
+            raise CommandError(f"Cannot import {path}: the batch of names up to line {line} was rejected: {exc!r}")
+
+        if options["verbosity"] > 0:
+            self.stdout.write(self.style.SUCCESS(
+                f"{len(ids)} categories imported in {time.perf_counter() - started:.1f}s."))
@@ -0,0 +1,32 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from category.transfer import import_tree
+
+
+class Command(BaseCommand):
+    """Imports a directory written by ``export_tree`` (or by sqlalchemy-mptt-exmpl).
+
+    Rows are loaded with ``COPY ... FROM STDIN`` on PostgreSQL and batched ``executemany``
+    elsewhere, then names, counters, the closure and broken nested sets are fixed in bulk.
+    """
+
+    help = "Imports the category tables from a directory of gzipped CSV files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--replace", action="store_true", help="delete the existing categories first")
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            counts = import_tree(options["directory"], replace=options["replace"], batch_size=options["batch_size"])
+        except (OSError, ValueError, csv.Error, DatabaseError) as exc:
+            raise CommandError(f"Cannot import {options['directory']}: {exc!r}")
+        if options["verbosity"] > 0:
+            rows = ", ".join(f"{table}: {count}" for table, count in counts.items())
+            self.stdout.write(self.style.SUCCESS(f"Imported {rows} in {time.perf_counter() - started:.1f}s."))
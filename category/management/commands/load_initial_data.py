@@ -1,29 +1,71 @@
+import hashlib
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.files.storage import default_storage, FileSystemStorage
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
 
 from wagtail.core.models import Site, Page
 
+from category.loading import load_fixture
+
+CHUNK_SIZE = 1024 * 1024
+
 
 class Command(BaseCommand):
     help = 'Load initial data'
 
-    def _copy_files(self, local_storage, path):
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='parallel media uploads')
+        parser.add_argument('--batch-size', type=int, default=1000, help='objects per INSERT and model')
+
+    def _iter_files(self, local_storage, path):
+        """relative names of all files below path"""
+        directories, file_names = local_storage.listdir(path)
+        for directory in directories:
+            yield from self._iter_files(local_storage, path + directory + '/')
+        for file_name in file_names:
+            yield path + file_name
+
+    @staticmethod
+    def _digest(storage, name):
+        digest = hashlib.sha256()
+        with storage.open(name) as file_:
+            for chunk in file_.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _copy_file(self, local_storage, name):
+        """copies one file unless the target has the same size and content, returns what was done"""
+        if default_storage.exists(name):
+            if default_storage.size(name) == local_storage.size(name) \
+                    and self._digest(default_storage, name) == self._digest(local_storage, name):
+                return 'unchanged'
+            # save() would store the new content under another name instead of replacing it
+            default_storage.delete(name)
+        with local_storage.open(name) as file_:
+            # storages read File objects through chunks(), never the whole file at once
+            file_.DEFAULT_CHUNK_SIZE = CHUNK_SIZE
+            default_storage.save(name, file_)
+        return 'copied'
+
+    def _copy_files(self, local_storage, path, workers=8):
         """
-        Recursively copy files from local_storage to default_storage. Used
+        Copy the files below path from local_storage to default_storage. Used
         to automatically bootstrap the media directory (both locally and on
         cloud providers) with the images linked from the initial data (and
         included in MEDIA_ROOT).
+
+        Uploads run in a bounded thread pool, as they mostly wait for I/O, and
+        files whose size and SHA-256 already match in the target are skipped,
+        so repeated runs only copy what changed.
         """
-        directories, file_names = local_storage.listdir(path)
-        for directory in directories:
-            self._copy_files(local_storage, path + directory + '/')
-        for file_name in file_names:
-            with local_storage.open(path + file_name) as file_:
-                default_storage.save(path + file_name, file_)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda name: self._copy_file(local_storage, name),
+                                   self._iter_files(local_storage, path))
+            return Counter(results)
 
     def handle(self, **options):
         commands_dir = os.path.join(settings.PROJECT_DIR, 'home', 'fixtures')
@@ -32,7 +74,8 @@ class Command(BaseCommand):
         print("Copying media files to configured storage...")
 
         local_storage = FileSystemStorage(os.path.join(commands_dir, 'media'))
-        self._copy_files(local_storage, '')  # file storage paths are relative
+        copied = self._copy_files(local_storage, '', options['workers'])  # file storage paths are relative
+        print(f"{copied['copied']} media files copied, {copied['unchanged']} unchanged.")
 
         # Wagtail creates default Site and Page instances during install, but we already have
         # them in the data load. Remove the auto-generated ones.
@@ -41,7 +84,8 @@ class Command(BaseCommand):
         if Page.objects.filter(title='Welcome to your new Wagtail site!').exists():
             Page.objects.get(title='Welcome to your new Wagtail site!').delete()
 
-        call_command('loaddata', commands_file, verbosity=0)
+        # streamed and bulk inserted, loaddata would parse the whole fixture into memory
+        load_fixture(commands_file, batch_size=options['batch_size'])
 
         self.stdout.write(
             self.style.SUCCESS("Awesome. Your data is loaded!"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from category.models import CategoryClosure
+
+
+class Command(BaseCommand):
+    """Recomputes the CategoryClosure projection from the CategoryMPTT nested sets."""
+
+    help = "Recomputes the category closure table from CategoryMPTT."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tree-id", type=int, action="append", dest="tree_ids",
+                            help="rebuild only this tree (can be repeated)")
+
+    def handle(self, *args, **options):
+        rows = CategoryClosure.objects.rebuild(tree_ids=options["tree_ids"])
+        if options["verbosity"] > 0:
+            self.stdout.write(self.style.SUCCESS(f"Closure rebuilt: {rows} rows."))
+        if not CategoryClosure.enabled() and options["verbosity"] > 0:
+            self.stdout.write(self.style.WARNING(
+                "CATEGORY_CLOSURE_ENABLED is off, the table will not follow later tree changes."))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from category.models import CategoryMPTT
+from category.versioning import bump_tree_version
+
+
+class Command(BaseCommand):
+    """Recomputes CategoryMPTT.child_count and CategoryMPTT.descendant_count.
+
+    The counters are maintained incrementally on insert, move and delete; this command
+    repairs them after raw SQL, queryset deletes or imports that bypass the model.
+    """
+
+    help = "Recomputes child_count and descendant_count of CategoryMPTT nodes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tree-id", type=int, action="append", dest="tree_ids",
+                            help="rebuild only this tree (can be repeated)")
+
+    @staticmethod
+    def rebuild_counts(tree_ids=None) -> int:
+        children = (
+            CategoryMPTT.objects.filter(parent=OuterRef("pk")).order_by()
+            .values("parent").annotate(count=Count("pk")).values("count")
+        )
+        descendants = (
+            CategoryMPTT.objects.filter(tree_id=OuterRef("tree_id"), lft__gt=OuterRef("lft"), lft__lt=OuterRef("rgt"))
+            .order_by().values("tree_id").annotate(count=Count("pk")).values("count")
+        )
+        queryset = CategoryMPTT.objects.all()
+        if tree_ids:
+            queryset = queryset.filter(tree_id__in=tree_ids)
+        with transaction.atomic():
+            updated = queryset.update(
+                child_count=Coalesce(Subquery(children, output_field=IntegerField()), 0),
+                descendant_count=Coalesce(Subquery(descendants, output_field=IntegerField()), 0),
+            )
+            # the API responses serialize the counters
+            for tree_id in tree_ids or [None]:
+                bump_tree_version(CategoryMPTT, tree_id)
+            return updated
+
+    def handle(self, *args, **options):
+        updated = self.rebuild_counts(options["tree_ids"])
+        if options["verbosity"] > 0:
+            self.stdout.write(self.style.SUCCESS(f"Counts rebuilt for {updated} nodes."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from category.models import CategoryMPTT
+
+
+class Command(BaseCommand):
+    """Backfills CategoryMPTT.name from Category.name.
+
+    New and re-linked nodes copy the name on save and renames are propagated by a signal;
+    this command fills existing rows and repairs raw SQL or queryset updates that bypass both.
+    The table is walked in primary key ranges, so no single UPDATE locks it for long.
+    """
+
+    help = "Copies Category.name into CategoryMPTT.name."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="primary keys per UPDATE")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        bounds = CategoryMPTT.objects.aggregate(first=Min("pk"), last=Max("pk"))
+        updated = 0
+        if bounds["first"] is not None:
+            for start in range(bounds["first"], bounds["last"] + 1, batch_size):
+                updated += CategoryMPTT.objects.sync_names(
+                    CategoryMPTT.objects.filter(pk__gte=start, pk__lt=start + batch_size))
+        if options["verbosity"] > 0:
+            self.stdout.write(self.style.SUCCESS(f"Names synced for {updated} nodes."))
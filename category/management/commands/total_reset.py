@@ -1,9 +1,15 @@
 import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
 
 import psycopg2
+from psycopg2 import sql
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
 import logging
 
 DATABASE_CONNECTION_DETAILS = {}
@@ -15,31 +21,40 @@ for database, conn_details in settings.DATABASES.items():
     }
 logger = logging.getLogger(__name__)
 
+# the snapshot of database "x" is the database "x_snapshot" or the file "x.snapshot"
+SNAPSHOT_SUFFIX = "_snapshot"
+
 
 class Command(BaseCommand):
-    """DEV ONLY: Dumps the entire DB and sets up everything anew."""
+    """DEV ONLY: Dumps the entire DB and sets up everything anew.
+
+    With ``--snapshot`` the result of the full setup is kept as a PostgreSQL template database
+    (a copy of the file on SQLite) and later resets clone it instead of running the setup again.
+    The snapshot records its applied migrations like any database; when migrations on disk are
+    not applied to it, the setup runs again and replaces it.
+    """
 
     help = "DEV ONLY: Dumps the entire DB and sets up everything anew."
-    requires_system_checks = False
+    requires_system_checks = []
 
-    @staticmethod
-    def _terminate_db_connections(database):
+    def add_arguments(self, parser):
+        parser.add_argument("--snapshot", action="store_true",
+                            help="restore the snapshot of the last full setup, create it if there is none")
+        parser.add_argument("--refresh-snapshot", action="store_true",
+                            help="run the full setup and save it as the new snapshot")
+
+    def _terminate_db_connections(self, database, dbname=None):
         """Terminates the database connections to be able to drop the database"""
         conn_kwargs = DATABASE_CONNECTION_DETAILS[database]
         # if len(conn_kwargs) = 1 then it's a connection to sqlite
         # if len(conn_kwargs) > 1 then it's a connection to postgres
         if len(conn_kwargs) > 1:
-            postgres_db_conn_kwargs = conn_kwargs.copy()
-            postgres_db_conn_kwargs["dbname"] = "postgres"
-            conn = psycopg2.connect(**postgres_db_conn_kwargs)
-            conn.autocommit = True
-            cur = conn.cursor()
-            # DANGER: Not using prepared variables here. hardcore python formatting.
-            cur.execute(
-                "SELECT pg_terminate_backend(pg_stat_activity.pid) FROM pg_stat_activity WHERE pg_stat_activity.datname = '{}' AND pid <> pg_backend_pid();".format(
-                    conn_kwargs["dbname"]
+            with self._admin_cursor(database) as cur:
+                cur.execute(
+                    "SELECT pg_terminate_backend(pg_stat_activity.pid) FROM pg_stat_activity "
+                    "WHERE pg_stat_activity.datname = %s AND pid <> pg_backend_pid();",
+                    [dbname or conn_kwargs["dbname"]],
                 )
-            )
 
     @staticmethod
     def _create_db(database):
@@ -96,6 +111,83 @@ class Command(BaseCommand):
             os.remove(dbfile)
             logger.debug("Removed database file: {}".format(dbfile))
 
+    @staticmethod
+    @contextmanager
+    def _admin_cursor(database, dbname="postgres"):
+        """autocommit cursor on ``dbname`` of a postgres connection (the maintenance database), closed afterwards"""
+        postgres_db_conn_kwargs = DATABASE_CONNECTION_DETAILS[database].copy()
+        postgres_db_conn_kwargs["dbname"] = dbname
+        with closing(psycopg2.connect(**postgres_db_conn_kwargs)) as conn:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                yield cur
+
+    @staticmethod
+    def _copy_sqlite(source, target):
+        """consistent page by page copy of a sqlite file, the target is replaced"""
+        with closing(sqlite3.connect(source)) as src, closing(sqlite3.connect(target)) as dst:
+            src.backup(dst)
+
+    @staticmethod
+    def _snapshot_names(database):
+        """(database, snapshot) names of a connection"""
+        conn_kwargs = DATABASE_CONNECTION_DETAILS[database]
+        if len(conn_kwargs) > 1:
+            return conn_kwargs["dbname"], conn_kwargs["dbname"] + SNAPSHOT_SUFFIX
+        return conn_kwargs["dbname"], conn_kwargs["dbname"] + ".snapshot"
+
+    def _snapshot_exists(self, database):
+        _dbname, snapshot = self._snapshot_names(database)
+        if len(DATABASE_CONNECTION_DETAILS[database]) > 1:
+            with self._admin_cursor(database) as cur:
+                cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", [snapshot])
+                return cur.fetchone() is not None
+        return os.path.exists(snapshot)
+
+    @staticmethod
+    @contextmanager
+    def _snapshot_connection(database):
+        """
+        a Django connection like ``database`` to its snapshot, closed afterwards; it gets an alias
+        of its own, the migration recorder queries through ``connections[alias]``
+        """
+        _dbname, snapshot = Command._snapshot_names(database)
+        alias = database + SNAPSHOT_SUFFIX
+        connections.settings[alias] = {**connections[database].settings_dict, "NAME": snapshot}
+        try:
+            yield connections[alias]
+        finally:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+
+    def _snapshot_is_current(self, database):
+        """
+        whether the snapshot exists and has no migration on disk left to apply, squashed
+        migrations count as applied when their replaced migrations are
+        """
+        if not self._snapshot_exists(database):
+            return False
+        with self._snapshot_connection(database) as connection:
+            executor = MigrationExecutor(connection)
+            return not executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+    def _clone_db(self, database, source, target):
+        """replaces the database ``target`` with a copy of ``source``, both unused"""
+        conn_kwargs = DATABASE_CONNECTION_DETAILS[database]
+        connections[database].close()
+        if len(conn_kwargs) > 1:
+            # CREATE DATABASE ... TEMPLATE needs the template without any connections
+            self._terminate_db_connections(database, source)
+            self._terminate_db_connections(database, target)
+            with self._admin_cursor(database) as cur:
+                cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(target)))
+                cur.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(
+                    sql.Identifier(target), sql.Identifier(source)))
+        else:
+            self._copy_sqlite(source, target)
+        logger.debug("Copied database {} to {}".format(source, target))
+
     def handle(self, *args, **options):
         """entry point"""
         verbosity = options["verbosity"]
@@ -103,6 +195,21 @@ class Command(BaseCommand):
             # YOU SHOULD NEVER TRUST THIS COMMAND FOR PRODUCTION USAGE.
             raise RuntimeError("Command can not be run in production.")
 
+        started = time.perf_counter()
+        if options["snapshot"] and not options["refresh_snapshot"]:
+            if all(self._snapshot_is_current(database) for database in settings.DATABASES.keys()):
+                # a file/template copy instead of migrations and setup commands, a second or so
+                for database in settings.DATABASES.keys():
+                    dbname, snapshot = self._snapshot_names(database)
+                    self._clone_db(database, snapshot, dbname)
+                if verbosity > 0:
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Restored the snapshot in {time.perf_counter() - started:.1f}s. "
+                        f"Use --refresh-snapshot after setup changes, new migrations refresh it."))
+                return
+            if verbosity > 0:
+                self.stdout.write("No snapshot of the current migrations, running the full setup.")
+
         for database in settings.DATABASES.keys():
             self._terminate_db_connections(database)
             self._create_or_recreate_db(database)
@@ -125,3 +232,10 @@ class Command(BaseCommand):
         call_command("sync_locale_trees", verbosity=verbosity)
         if verbosity > 0:
             self.stdout.write(self.style.SUCCESS("Locale trees synced."))
+
+        if options["snapshot"] or options["refresh_snapshot"]:
+            for database in settings.DATABASES.keys():
+                dbname, snapshot = self._snapshot_names(database)
+                self._clone_db(database, dbname, snapshot)
+            if verbosity > 0:
+                self.stdout.write(self.style.SUCCESS("Snapshot saved."))
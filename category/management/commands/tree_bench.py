@@ -0,0 +1,225 @@
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from category.models import Category, CategoryMPTT, CategoryTreeBeard
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ["insert", "get_descendants", "get_ancestors", "count_children", "render", "move", "delete"]
+
+
+class Rollback(Exception):
+    """raised to roll back everything the benchmark wrote"""
+
+
+class MPTTWorkload:
+    label = "mptt"
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.root = None
+        self.categories = []
+
+    def prepare(self, depth, fanout):
+        """the categories the nodes point to, created outside of the timed insert"""
+        count = sum(fanout ** level for level in range(depth + 1))
+        self.categories = Category.objects.bulk_create(
+            [Category(name=f"{self.prefix}-mptt-{number}") for number in range(1, count + 1)])
+
+    def insert(self, depth, fanout):
+        categories = iter(self.categories)
+
+        def create(parent):
+            return CategoryMPTT.objects.create(category=next(categories), parent=parent)
+
+        self.root = create(None)
+        level = [self.root]
+        for _ in range(depth):
+            level = [create(parent) for parent in level for _ in range(fanout)]
+        self.root.refresh_from_db()
+
+    def nodes(self):
+        return list(self.root.get_descendants(include_self=True))
+
+    @staticmethod
+    def get_descendants(node):
+        return list(node.get_descendants())
+
+    @staticmethod
+    def get_ancestors(node):
+        return list(node.get_ancestors())
+
+    @staticmethod
+    def count_children(node):
+        return node.get_children().count()
+
+    def render(self):
+        nodes = self.root.get_descendants(include_self=True)
+        return "\n".join(f"{'  ' * node.level}{node}" for node in nodes)
+
+    @staticmethod
+    def move(node, target):
+        node.move_to(target, "last-child")
+
+    @staticmethod
+    def delete(node):
+        node.delete()
+
+
+class TreeBeardWorkload:
+    label = "treebeard"
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.root = None
+
+    def prepare(self, depth, fanout):
+        """the names are stored in the nodes themselves, nothing to create up front"""
+
+    def insert(self, depth, fanout):
+        counter = 0
+
+        def name():
+            nonlocal counter
+            counter += 1
+            return f"{self.prefix}-treebeard-{counter}"
+
+        manager = CategoryTreeBeard.objects
+        self.root = manager.add_root({"name": name()})
+        level = [self.root]
+        for _ in range(depth):
+            level = [manager.add_child(parent, {"name": name()}) for parent in level for _ in range(fanout)]
+        self.root.refresh_from_db()
+
+    def nodes(self):
+        return list(CategoryTreeBeard.objects.get_tree(self.root))
+
+    @staticmethod
+    def get_descendants(node):
+        return list(CategoryTreeBeard.objects.get_descendants(node))
+
+    @staticmethod
+    def get_ancestors(node):
+        return list(CategoryTreeBeard.objects.get_ancestors(node))
+
+    @staticmethod
+    def count_children(node):
+        return CategoryTreeBeard.objects.get_children_count(node)
+
+    def render(self):
+        nodes = CategoryTreeBeard.objects.get_tree(self.root)
+        return "\n".join(f"{'  ' * (node.depth - 1)}{node}" for node in nodes)
+
+    @staticmethod
+    def move(node, target):
+        CategoryTreeBeard.objects.move(node, target, "last-child")
+
+    @staticmethod
+    def delete(node):
+        node.delete()
+
+
+WORKLOADS = {workload.label: workload for workload in (MPTTWorkload, TreeBeardWorkload)}
+
+
+class Command(BaseCommand):
+    """Compares nested sets (CategoryMPTT) and materialized paths (CategoryTreeBeard).
+
+    Both models get the same synthetic tree and the same operations. Everything runs in
+    one transaction that is rolled back at the end, so the database is left untouched.
+    """
+
+    help = "Benchmarks CategoryMPTT and CategoryTreeBeard on identical workloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--depth", type=int, default=3, help="levels below the root")
+        parser.add_argument("--fanout", type=int, default=5, help="children per node")
+        parser.add_argument("--samples", type=int, default=50,
+                            help="nodes used for the per-node read operations")
+        parser.add_argument("--models", nargs="+", choices=sorted(WORKLOADS), default=sorted(WORKLOADS))
+        parser.add_argument("--json", dest="json_path", help="write the results as JSON to this file ('-' for stdout)")
+
+    @contextmanager
+    def _measure(self, results, operation):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - started
+        results[operation] = {"seconds": round(elapsed, 6), "queries": len(queries.captured_queries)}
+        logger.debug("%s: %s", operation, results[operation])
+
+    def _run(self, workload, depth, fanout, samples):
+        results = {}
+        workload.prepare(depth, fanout)
+        with self._measure(results, "insert"):
+            workload.insert(depth, fanout)
+
+        nodes = workload.nodes()
+        # spread the samples over the whole tree
+        step = max(len(nodes) // samples, 1)
+        sampled = nodes[::step][:samples]
+
+        for operation in ("get_descendants", "get_ancestors", "count_children"):
+            method = getattr(workload, operation)
+            with self._measure(results, operation):
+                for node in sampled:
+                    method(node)
+
+        with self._measure(results, "render"):
+            workload.render()
+
+        branches = nodes[0].get_children() if fanout > 1 and depth > 0 else []
+        if len(branches) >= 3:
+            # move the first branch below the last one, then drop the second one
+            with self._measure(results, "move"):
+                workload.move(branches[0], branches[len(branches) - 1])
+            with self._measure(results, "delete"):
+                workload.delete(type(branches[1]).objects.get(pk=branches[1].pk))
+
+        results["nodes"] = len(nodes)
+        return results
+
+    def _write_table(self, report):
+        models = list(report["results"])
+        self.stdout.write(f"{'operation':<18}" + "".join(f"{model:>28}" for model in models))
+        for operation in OPERATIONS:
+            cells = []
+            for model in models:
+                result = report["results"][model].get(operation)
+                cells.append(f"{result['seconds'] * 1000:>14.2f} ms {result['queries']:>6} q"
+                             if result else f"{'-':>28}")
+            self.stdout.write(f"{operation:<18}" + "".join(f"{cell:>28}" for cell in cells))
+
+    def handle(self, *args, **options):
+        depth, fanout, samples = options["depth"], options["fanout"], options["samples"]
+        if samples < 1 or depth < 0 or fanout < 1:
+            raise CommandError("--samples and --fanout must be at least 1, --depth at least 0.")
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        report = {"depth": depth, "fanout": fanout, "samples": samples, "results": {}}
+
+        for label in options["models"]:
+            try:
+                with transaction.atomic():
+                    report["results"][label] = self._run(WORKLOADS[label](prefix), depth, fanout, samples)
+                    raise Rollback
+            except Rollback:
+                pass
+
+        json_path = options["json_path"]
+        if json_path == "-":
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._write_table(report)
+            if json_path:
+                with open(json_path, "w") as fp:
+                    json.dump(report, fp, indent=2)
+
+        if options["verbosity"] > 0 and json_path != "-":
+            self.stdout.write(self.style.SUCCESS("Benchmark finished, nothing was written to the database."))
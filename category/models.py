@@ -1,9 +1,24 @@
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, OuterRef, Subquery, When
+from django.db.models.query_utils import DeferredAttribute
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 # def xstr(s):
 #     return '' if s is None else str(s)
-from treebeard.mp_tree import MP_Node
+from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition, PathOverflow
+from treebeard.mp_tree import MP_Node, MP_NodeManager
+
+from category.breadcrumbs import ancestor_cache
+from category.bulk import allocate_ids, copy_objects
+from category.identity import current_identity_map
+from category.instrumentation import traced, tree_span
+from category.locks import locks_forest, tree_lock
+from category.versioning import bump_tree_version
 
 # import uuid
 # nb = dict(null=True, blank=True)
@@ -30,14 +45,423 @@ class CreateUpdateTracker(CreateTracker):
         abstract = True
 
 
+class CounterField(models.PositiveIntegerField):
+    """
+    Denormalized counter maintained by UPDATE ... SET x = x + n statements.
+
+    A stale in-memory value is never written back: on update the column is assigned to itself.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default", 0)
+        kwargs.setdefault("editable", False)
+        super().__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        if add:
+            return super().pre_save(model_instance, add)
+        return F(self.attname)
+
+
 class GetOrNoneManager(models.Manager):
     """returns none if object doesn't exist else model instance"""
 
+    def _attname(self, field: str) -> Optional[str]:
+        """column attribute of a plain (non-relational) field, ``None`` for other lookups"""
+        if field == "pk":
+            return self.model._meta.pk.attname
+        try:
+            model_field = self.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            return None
+        return None if model_field.is_relation else model_field.attname
+
     def get_or_none(self, **kwargs):
+        identity = current_identity_map()
+        attname = self._attname(next(iter(kwargs))) if identity is not None and len(kwargs) == 1 else None
+        if attname is not None:
+            instance = identity.get(self.model, attname, next(iter(kwargs.values())))
+            if instance is not None:
+                return instance
         try:
-            return self.get(**kwargs)
+            instance = self.get(**kwargs)
         except ObjectDoesNotExist:
             return None
+        if attname is not None:
+            identity.add(instance, attname)
+        return instance
+
+    def get_many_or_none(self, field: str, values: Iterable,
+                         chunk_size: int = 1000) -> Dict[Any, Optional[models.Model]]:
+        """
+        Resolves many values of a unique ``field`` with one ``IN`` query per ``chunk_size`` values.
+        Returns ``{value: instance or None}`` for every distinct value.
+        """
+        attname = self._attname(field)
+        if attname is None:
+            raise ValueError(f"{field} is not a plain field of {self.model.__name__}")
+        values = list(dict.fromkeys(values))
+        identity = current_identity_map()
+        found = {}
+        if identity is not None:
+            found = {value: instance for value in values
+                     if (instance := identity.get(self.model, attname, value)) is not None}
+        missing = [value for value in values if value not in found]
+        for start in range(0, len(missing), chunk_size):
+            for instance in self.filter(**{f"{attname}__in": missing[start:start + chunk_size]}):
+                found[getattr(instance, attname)] = instance
+                if identity is not None:
+                    identity.add(instance, attname)
+        return {value: found.get(value) for value in values}
+
+
+# adjacency list of (category_id, parent category_id) pairs or a nested dict
+# {category_id: {child_category_id: {...}, ...}, ...}
+TreeSpec = Union[Iterable[Tuple[int, Optional[int]]], Mapping[int, Optional[Mapping]]]
+
+
+class SubtreeRow(NamedTuple):
+    """lightweight node row, depth is relative to the subtree root"""
+    id: int
+    parent_id: Optional[int]
+    category_id: int
+    depth: int
+
+
+class CategoryMPTTManager(TreeManager):
+    """tree manager with bulk helpers for large category trees"""
+
+    @staticmethod
+    def _children_map(nodes: TreeSpec) -> Dict[Optional[int], List[int]]:
+        """returns {parent category_id: [child category_id, ...]}, roots are stored under None"""
+        children: Dict[Optional[int], List[int]] = defaultdict(list)
+        seen = set()
+
+        def add(category_id, parent_id):
+            if category_id in seen:
+                raise ValueError(f"category {category_id} occurs in the tree more than once")
+            seen.add(category_id)
+            children[parent_id].append(category_id)
+
+        if isinstance(nodes, Mapping):
+            stack = [(None, nodes)]
+            while stack:
+                parent_id, level = stack.pop()
+                for category_id, sub_level in level.items():
+                    add(category_id, parent_id)
+                    if sub_level:
+                        stack.append((category_id, sub_level))
+        else:
+            for category_id, parent_id in nodes:
+                add(category_id, parent_id)
+
+        unknown = set(children) - seen - {None}
+        if unknown:
+            raise ValueError(f"parent categories are not part of the tree: {sorted(unknown)}")
+        return children
+
+    @traced("mptt.bulk_load_tree")
+    @locks_forest
+    def bulk_load_tree(self, nodes: TreeSpec, batch_size: int = 1000) -> int:
+        """
+        Inserts a whole forest without django-mptt's per-node shifting.
+
+        ``lft``, ``rgt``, ``level`` and ``tree_id`` are computed in a single in-memory DFS
+        (siblings are ordered by ``category_id`` as ``MPTTMeta.order_insertion_by`` demands),
+        the ids are reserved up front and all rows are streamed with ``category.bulk`` (COPY on
+        PostgreSQL). New trees are appended after the existing ones.
+        In sparse mode (``CATEGORY_MPTT_GAP``) the values are spaced by the configured gap.
+        Returns the number of created nodes.
+        """
+        children = self._children_map(nodes)
+        for siblings in children.values():
+            siblings.sort()
+
+        opts = self.model._mptt_meta
+        step = self.model.numbering_step()
+        tree_id = first_tree_id = self._get_next_tree_id()
+        levels: List[List[Tuple[int, Optional[int], int, int, int]]] = []
+        visited = 0
+        for root_id in children.get(None, []):
+            counter = 1
+            # iterative DFS, deep catalogs must not hit the recursion limit
+            stack = [(root_id, None, 0, counter, iter(children.get(root_id, ())))]
+            while stack:
+                category_id, parent_id, level, lft, pending = stack[-1]
+                child_id = next(pending, None)
+                if child_id is not None:
+                    counter += step
+                    stack.append((child_id, category_id, level + 1, counter, iter(children.get(child_id, ()))))
+                    continue
+                stack.pop()
+                counter += step
+                while len(levels) <= level:
+                    levels.append([])
+                levels[level].append((category_id, parent_id, lft, counter, tree_id))
+                visited += 1
+            tree_id += 1
+
+        if visited != sum(len(siblings) for siblings in children.values()):
+            raise ValueError("the tree contains cycles")
+
+        # the ids are known before the first row is written, children reference them directly
+        node_ids = dict(zip((row[0] for rows in levels for row in rows), allocate_ids(self.model, visited, self.db)))
+
+        def build():
+            for level, rows in enumerate(levels):
+                for category_id, parent_id, lft, rgt, node_tree_id in rows:
+                    node = self.model(pk=node_ids[category_id], category_id=category_id,
+                                      parent_id=node_ids[parent_id] if parent_id is not None else None,
+                                      child_count=len(children.get(category_id, ())),
+                                      descendant_count=((rgt - lft) // step - 1) // 2)
+                    setattr(node, opts.left_attr, lft)
+                    setattr(node, opts.right_attr, rgt)
+                    setattr(node, opts.level_attr, level)
+                    setattr(node, opts.tree_id_attr, node_tree_id)
+                    yield node
+
+        copy_objects(self.model, build(), batch_size=batch_size, using=self.db)
+        self.sync_names(self.filter(tree_id__gte=first_tree_id, tree_id__lt=tree_id))
+        if CategoryClosure.enabled():
+            CategoryClosure.objects.rebuild(tree_ids=range(first_tree_id, tree_id))
+        bump_tree_version(self.model, using=self.db)
+        return visited
+
+    def sync_names(self, queryset=None) -> int:
+        """
+        Copies ``Category.name`` into ``name`` of ``queryset`` (all nodes by default) with a
+        single UPDATE, rows that are already in sync are not written. Returns the updated rows;
+        when there are any, the tree versions are bumped.
+        """
+        names = Subquery(Category.objects.filter(pk=OuterRef("category_id")).values("name")[:1])
+        queryset = self.all() if queryset is None else queryset
+        updated = queryset.exclude(name=names).update(name=names)
+        if updated:
+            bump_tree_version(self.model, using=queryset.db)
+        return updated
+
+    def iter_subtree(self, node: "CategoryMPTT", chunk_size: int = 2000,
+                     include_self: bool = False) -> Iterator[SubtreeRow]:
+        """
+        Streams the descendants of ``node`` in ``lft`` order without loading them all at once.
+
+        PostgreSQL reads through a server-side cursor, other backends page by ``lft``
+        (keyset pagination), so memory stays bounded by ``chunk_size``.
+        """
+        opts = self.model._mptt_meta
+        left_attr, right_attr, level_attr = opts.left_attr, opts.right_attr, opts.level_attr
+        base_level = getattr(node, level_attr)
+        left = getattr(node, left_attr) - (1 if include_self else 0)
+        queryset = self._mptt_filter(tree_id=getattr(node, opts.tree_id_attr),
+                                     left__lt=getattr(node, right_attr)).order_by(left_attr)
+        fields = ("id", "parent_id", "category_id", level_attr, left_attr)
+
+        if connections[queryset.db].vendor == "postgresql":
+            rows = queryset.filter(**{f"{left_attr}__gt": left}).values_list(*fields).iterator(chunk_size=chunk_size)
+            for pk, parent_id, category_id, level, _ in rows:
+                yield SubtreeRow(pk, parent_id, category_id, level - base_level)
+            return
+
+        while True:
+            chunk = list(queryset.filter(**{f"{left_attr}__gt": left}).values_list(*fields)[:chunk_size])
+            for pk, parent_id, category_id, level, _ in chunk:
+                yield SubtreeRow(pk, parent_id, category_id, level - base_level)
+            if len(chunk) < chunk_size:
+                return
+            left = chunk[-1][-1]
+
+    def under_any(self, nodes, include_self: bool = True):
+        """
+        Nodes in the subtrees of any of ``nodes``. Uses the closure table (an indexed equality
+        join) when it is enabled, otherwise one ``lft`` range per node.
+        """
+        if CategoryClosure.enabled():
+            links = CategoryClosure.objects.filter(ancestor__in=nodes)
+            if not include_self:
+                links = links.filter(depth__gt=0)
+            return self.filter(pk__in=links.values("descendant_id"))
+        condition = models.Q(pk__in=[])
+        for node in nodes:
+            condition |= models.Q(tree_id=node.tree_id, lft__gte=node.lft if include_self else node.lft + 1,
+                                  lft__lt=node.rgt)
+        return self.filter(condition)
+
+    def check_trees(self, sparse: Optional[bool] = None) -> Counter:
+        """
+        Validates the nested sets in one pass and returns ``{tree_id: broken nodes}``.
+
+        Every node is checked against its parent and its previous/next sibling only (window
+        functions over ``(tree_id, parent_id)`` ordered by ``lft``): roots start at 1 on level 0,
+        siblings are contiguous, the first child starts right after its parent's ``lft``, the
+        last child ends right before its parent's ``rgt``, leaves span exactly two values and
+        ``level`` is the parent's plus one. Together these rule out gaps, overlaps and nodes
+        hanging in the wrong tree. A node in the wrong tree also marks its parent's tree.
+
+        With ``sparse`` (the default in sparse mode) values only have to increase, the gaps
+        between them are free slots.
+        """
+        if sparse is None:
+            sparse = self.model.numbering_step() > 1
+        if sparse:
+            siblings = "n.lft <= COALESCE(n.prev_rgt, p.lft) OR (n.next_lft IS NULL AND n.rgt >= p.rgt)"
+            root, leaf = "n.lft < 1", "1 = 0"
+        else:
+            siblings = "n.lft <> COALESCE(n.prev_rgt, p.lft) + 1 OR (n.next_lft IS NULL AND n.rgt + 1 <> p.rgt)"
+            root, leaf = "n.lft <> 1", "n.rgt <> n.lft + 1"
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT n.tree_id, p.tree_id, COUNT(*) FROM ("
+                f"  SELECT id, parent_id, tree_id, lft, rgt, level,"
+                f"         LAG(rgt) OVER siblings AS prev_rgt, LEAD(lft) OVER siblings AS next_lft"
+                f"  FROM {table} WINDOW siblings AS (PARTITION BY tree_id, parent_id ORDER BY lft)"
+                f") n LEFT JOIN {table} p ON p.id = n.parent_id "
+                f"WHERE n.rgt <= n.lft"
+                f" OR (n.parent_id IS NULL AND ({root} OR n.level <> 0 OR n.prev_rgt IS NOT NULL))"
+                f" OR (n.parent_id IS NOT NULL AND (p.tree_id <> n.tree_id OR n.level <> p.level + 1 OR {siblings}))"
+                f" OR ({leaf} AND NOT EXISTS (SELECT 1 FROM {table} c WHERE c.parent_id = n.id)) "
+                f"GROUP BY n.tree_id, p.tree_id"
+            )
+            broken: Counter = Counter()
+            for tree_id, parent_tree_id, count in cursor.fetchall():
+                broken[tree_id] += count
+                if parent_tree_id is not None and parent_tree_id != tree_id:
+                    broken[parent_tree_id] += count
+        return broken
+
+    @traced("mptt.repair_trees")
+    @locks_forest
+    def repair_trees(self, tree_ids: Iterable[int], batch_size: int = 1000) -> List[int]:
+        """
+        Renumbers only the given trees from their ``parent`` links, keeping the current sibling
+        order, and returns the ids of the repaired trees. Only rows that change are written.
+        Extra roots sharing a ``tree_id`` get new trees. Unlike ``partial_rebuild()`` it copes
+        with nodes filed under the wrong ``tree_id`` (pass both trees) and never loads more
+        than the tree columns.
+        """
+        return self._renumber(tree_ids, batch_size)
+
+    def _renumber(self, tree_ids: Iterable[int], batch_size: int = 1000) -> List[int]:
+        """``repair_trees()`` without the forest lock, callers hold the locks of ``tree_ids``"""
+        step = self.model.numbering_step()
+        tree_ids = sorted(set(tree_ids))
+        rows = list(self.filter(tree_id__in=tree_ids).order_by("lft", "pk")
+                    .values_list("pk", "parent_id", "tree_id", "lft", "rgt", "level"))
+        current = {row[0]: row[2:] for row in rows}
+        children: Dict[int, List[int]] = defaultdict(list)
+        roots: List[Tuple[int, int]] = []
+        for pk, parent_id, tree_id, *_ in rows:
+            if parent_id is None:
+                roots.append((tree_id, pk))
+            elif parent_id in current:
+                children[parent_id].append(pk)
+            else:
+                raise ValueError(f"node {pk} has its parent {parent_id} outside of the trees {tree_ids}")
+
+        numbered: Dict[int, Tuple[int, int, int, int]] = {}
+        used_tree_ids = set()
+        next_tree_id = None
+        for tree_id, root in sorted(roots):
+            if tree_id in used_tree_ids:
+                next_tree_id = next_tree_id or self._get_next_tree_id()
+                tree_id, next_tree_id = next_tree_id, next_tree_id + 1
+            used_tree_ids.add(tree_id)
+            value = 1
+            lefts = {root: value}
+            stack = [(root, 0, iter(children[root]))]
+            while stack:
+                pk, level, pending = stack[-1]
+                child = next(pending, None)
+                value += step
+                if child is None:
+                    stack.pop()
+                    numbered[pk] = (tree_id, lefts.pop(pk), value, level)
+                else:
+                    lefts[child] = value
+                    stack.append((child, level + 1, iter(children[child])))
+        if len(numbered) != len(current):
+            raise ValueError(f"nodes not reachable from a root (cycle in the parent links): "
+                             f"{sorted(set(current) - set(numbered))}")
+
+        opts = self.model._mptt_meta
+        fields = [opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr]
+        changed = [
+            self.model(pk=pk, **dict(zip(fields, values)))
+            for pk, values in numbered.items() if values != current[pk]
+        ]
+        self.bulk_update(changed, fields, batch_size=batch_size)
+        bump_tree_version(self.model, using=self.db)
+        return sorted(used_tree_ids)
+
+    def _make_room(self, parent_id: int, reserve: int, batch_size: int = 1000):
+        """
+        Sparse mode: spreads the subtree of the closest ancestor of ``parent_id`` (itself
+        included) whose ``lft``/``rgt`` range still has room evenly over that range, with
+        ``reserve`` free values before the end of ``parent_id``. Only that subtree is written,
+        a full root is widened. Callers hold the lock of the tree.
+        """
+        step = self.model.numbering_step()
+        parent = self.filter(pk=parent_id).values("tree_id", "lft", "rgt").get()
+        ancestors = self.filter(tree_id=parent["tree_id"], lft__lte=parent["lft"], rgt__gte=parent["rgt"]) \
+            .order_by("-lft").values_list("pk", "lft", "rgt", "descendant_count", "parent_id")
+        for pk, lft, rgt, descendant_count, ancestor_parent_id in ancestors:
+            if ancestor_parent_id is None or (rgt - lft - reserve) // (2 * descendant_count + 1) >= 3:
+                break
+        rows = list(self.filter(tree_id=parent["tree_id"], lft__gt=lft, rgt__lt=rgt).values_list("pk", "lft", "rgt"))
+        spacing = (rgt - lft - reserve) // (2 * len(rows) + 1)
+        if spacing < 3:
+            if ancestor_parent_id is not None:
+                # the counters are off, fall back to the whole tree
+                self._renumber([parent["tree_id"]], batch_size)
+                return
+            spacing = step
+            rgt = lft + spacing * (2 * len(rows) + 1) + reserve
+
+        values = {}
+        value = lft
+        bounds = [(row[1], False, row[0]) for row in rows] + [(row[2], True, row[0]) for row in rows]
+        for _value, is_right, node in sorted(bounds):
+            if is_right and node == parent_id:
+                value += reserve
+            value += spacing
+            values.setdefault(node, []).append(value)
+        opts = self.model._mptt_meta
+        changed = [self.model(pk=node, **{opts.left_attr: new_lft, opts.right_attr: new_rgt})
+                   for node, (new_lft, new_rgt) in values.items()]
+        changed.append(self.model(pk=pk, **{opts.left_attr: lft, opts.right_attr: rgt}))
+        self.bulk_update(changed, [opts.left_attr, opts.right_attr], batch_size=batch_size)
+
+
+class CategoryManager(GetOrNoneManager):
+    def _upsert_batch(self, names: List[str]) -> Dict[str, int]:
+        # DO NOTHING leaves existing rows alone (DO UPDATE would rewrite every one of them just to
+        # have them returned), their ids are read back with the new ones
+        self.bulk_create([self.model(name=name) for name in names], ignore_conflicts=True)
+        return dict(self.filter(name__in=names).values_list("name", "id"))
+
+    @traced("category.bulk_upsert")
+    def bulk_upsert(self, names: Iterable[str], batch_size: int = 5000) -> Dict[str, int]:
+        """
+        Creates the missing categories of ``names`` and returns ``{name: id}`` for all of them.
+
+        ``names`` is consumed lazily and deduplicated in memory, every ``batch_size`` new names
+        are written by one ``INSERT ... ON CONFLICT DO NOTHING`` followed by one ``SELECT`` of
+        the ids of new and existing rows alike. Running it twice with the same input changes
+        nothing, batches commit independently.
+        """
+        ids: Dict[str, int] = {}
+        batch: Dict[str, None] = {}
+        for name in names:
+            if name in ids or name in batch:
+                continue
+            batch[name] = None
+            if len(batch) >= batch_size:
+                ids.update(self._upsert_batch(list(batch)))
+                batch.clear()
+        if batch:
+            ids.update(self._upsert_batch(list(batch)))
+        return ids
 
 
 class Category(CreateTracker):
@@ -48,7 +472,7 @@ class Category(CreateTracker):
     # id = models.AutoField(primary_key=True)
 
     name = models.CharField(max_length=256, unique=True)
-    objects = GetOrNoneManager()
+    objects = CategoryManager()
 
     class Meta:
         db_table = get_table_name("category")
@@ -66,6 +490,19 @@ class CategoryMPTT(MPTTModel, CreateUpdateTracker):
 
     parent = TreeForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    # denormalized Category.name, see _sync_name(), category.signals and the sync_names command
+    name = models.CharField(max_length=256, blank=True, default="", editable=False, db_index=True)
+    # denormalized counts, see _update_ancestor_counts() and the rebuild_counts command
+    child_count = CounterField()
+    descendant_count = CounterField()
+    # django-mptt's default int4 columns overflow in sparse mode, one node takes two steps
+    lft = models.PositiveBigIntegerField(db_index=True, editable=False)
+    rgt = models.PositiveBigIntegerField(db_index=True, editable=False)
+    objects = CategoryMPTTManager()
+
+    # see category.versioning
+    tree_key_field = "tree_id"
+    tree_key_lookup = "tree_id"
 
     class Meta:
         db_table = get_table_name("category_mptt")
@@ -76,7 +513,392 @@ class CategoryMPTT(MPTTModel, CreateUpdateTracker):
         left_attr = 'lft'
 
     def __str__(self):
-        return f'{self.category}'
+        # falls back to the category for rows written before the name was denormalized
+        return self.name or f'{self.category}'
+
+    @property
+    def tree_key(self) -> int:
+        return self.tree_id
+
+    @staticmethod
+    def numbering_step() -> int:
+        """
+        Distance between consecutive ``lft``/``rgt`` values: 1 for dense nested sets, the
+        ``CATEGORY_MPTT_GAP`` free values plus one in sparse mode (gaps below 2 hold no node).
+        """
+        gap = getattr(settings, "CATEGORY_MPTT_GAP", 0)
+        return gap + 1 if gap >= 2 else 1
+
+    def get_descendant_count(self):
+        """the counter in sparse mode, ``rgt - lft`` no longer counts the nodes in between"""
+        if self.numbering_step() > 1:
+            return self.descendant_count
+        return super().get_descendant_count()
+
+    def get_leafnodes(self, include_self=False):
+        if self.numbering_step() > 1:
+            return self.get_descendants(include_self=include_self).filter(child_count=0)
+        return super().get_leafnodes(include_self=include_self)
+
+    def _take_free_slot(self):
+        """
+        Sparse mode: presets the tree fields of a new child to a free slot between its siblings.
+        Like django-mptt's ordered insertion it goes right after the last sibling (in ``lft``
+        order) whose ``category_id`` is not greater, siblings moved out of ``category_id`` order
+        keep their place. django-mptt leaves preset ``lft``/``rgt`` alone, so no other row is
+        shifted. Appends take a fixed slice of a quarter step, when the gap at the position has
+        run out the closest ancestor with room is spread out by ``_make_room()``, keeping space
+        for as many appends as the parent has children, and as a last resort the tree is
+        renumbered.
+        """
+        manager = self._tree_manager
+        size = max(1, self.numbering_step() // 4)
+        for attempt in range(4):
+            parent = manager.filter(pk=self.parent_id).values("tree_id", "lft", "rgt", "level", "child_count").get()
+            siblings = manager.filter(parent_id=self.parent_id).order_by("lft")
+            before = siblings.filter(category_id__lte=self.category_id).values_list("rgt", flat=True).last()
+            after = siblings.filter(lft__gt=parent["lft"] if before is None else before) \
+                .values_list("lft", flat=True).first()
+            low = parent["lft"] if before is None else before
+            high = parent["rgt"] if after is None else after
+            if high - low >= 3:
+                break
+            if attempt < 2:
+                manager._make_room(self.parent_id, 2 * size * (parent["child_count"] + 1))
+            else:
+                manager._renumber([parent["tree_id"]])
+        else:
+            raise ValueError(f"no free slot under node {self.parent_id}, check the tree")
+
+        width = high - low
+        if after is None:
+            # appending is the common case, keep the rest of the gap for the next siblings
+            size = min(size, (width - 1) // 2)
+            lft, rgt = low + size, low + 2 * size
+        elif before is None:
+            size = min(size, (width - 1) // 2)
+            lft, rgt = high - 2 * size, high - size
+        else:
+            lft, rgt = low + width // 3, high - width // 3
+
+        opts = self._mptt_meta
+        setattr(self, opts.tree_id_attr, parent["tree_id"])
+        setattr(self, opts.left_attr, lft)
+        setattr(self, opts.right_attr, rgt)
+        setattr(self, opts.level_attr, parent["level"] + 1)
+
+    def _sync_name(self):
+        """copies the name of a new or changed category, from the cached instance when there is one"""
+        category = self._state.fields_cache.get("category")
+        if category is not None and category.pk == self.category_id:
+            self.name = category.name
+        else:
+            self.name = Category.objects.filter(pk=self.category_id).values_list("name", flat=True).first() or ""
+
+    def _update_ancestor_counts(self, parent_id: Optional[int], size: int):
+        """adds ``size`` nodes to the subtree counts of ``parent_id`` and all its ancestors"""
+        if parent_id is None:
+            return
+        manager = self._tree_manager
+        parent = manager.filter(pk=parent_id).values("tree_id", "lft", "rgt").first()
+        if parent is None:
+            return
+        manager.filter(pk=parent_id).update(child_count=F("child_count") + (1 if size > 0 else -1))
+        manager.filter(tree_id=parent["tree_id"], lft__lte=parent["lft"], rgt__gte=parent["rgt"]).update(
+            descendant_count=F("descendant_count") + size)
+
+    def _subtree_size(self) -> int:
+        return self._tree_manager.filter(pk=self.pk).values_list("descendant_count", flat=True).get() + 1
+
+    def _write_lock(self, *node_ids: Optional[int]):
+        """``tree_lock()`` on the trees of ``node_ids``, ``None`` (the root level) locks the whole forest"""
+        using = router.db_for_write(type(self), instance=self)
+        if None in node_ids:
+            return tree_lock(type(self), using=using)
+        manager = self._tree_manager.db_manager(using)
+        return tree_lock(type(self), lambda: manager.filter(pk__in=node_ids).values_list("tree_id", flat=True),
+                         using=using)
+
+    def _tree_fields_changed(self) -> bool:
+        """whether saving moves the node: a new parent or a new position among its siblings"""
+        return any(
+            value is not DeferredAttribute and value != self._mptt_meta.get_raw_field_value(self, field)
+            for field, value in self._mptt_cached_fields.items()
+        )
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        old_parent_id = None if adding else self._mptt_cached_fields.get(self._mptt_meta.parent_attr)
+        if adding:
+            lock = self._write_lock(self.parent_id)
+        elif getattr(self, "_moving", False) or not self._tree_fields_changed():
+            # plain updates do not shift the tree, moves are locked by move_to()
+            lock = transaction.atomic(using=router.db_for_write(type(self), instance=self))
+        else:
+            # roots are ordered too: moving one renumbers the trees
+            lock = self._write_lock(None if old_parent_id is None else self.pk, self.parent_id)
+        if adding or self._mptt_cached_fields.get("category_id") != self.category_id:
+            self._sync_name()
+        with lock, tree_span("mptt.insert" if adding else "mptt.save"):
+            if adding and self.parent_id is not None and self.numbering_step() > 1 \
+                    and getattr(self, self._mptt_meta.left_attr) is None:
+                self._take_free_slot()
+            super().save(*args, **kwargs)
+            if adding:
+                self._update_ancestor_counts(self.parent_id, 1)
+            elif not getattr(self, "_moving", False) and old_parent_id is not DeferredAttribute \
+                    and old_parent_id != self.parent_id:
+                size = self._subtree_size()
+                self._update_ancestor_counts(old_parent_id, -size)
+                self._update_ancestor_counts(self.parent_id, size)
+
+    save.alters_data = True
+
+    @traced("mptt.move")
+    def move_to(self, target, position="first-child"):
+        old_parent_id = self.parent_id
+        if target is None or self.parent_id is None or (target.parent_id is None and position in ("left", "right")):
+            lock = self._write_lock(None)
+        else:
+            lock = self._write_lock(self.pk, target.pk)
+        with lock:
+            self._moving = True
+            try:
+                super().move_to(target, position)
+            finally:
+                self._moving = False
+            if old_parent_id != self.parent_id:
+                size = self._subtree_size()
+                self._update_ancestor_counts(old_parent_id, -size)
+                self._update_ancestor_counts(self.parent_id, size)
+
+    @traced("mptt.delete")
+    def delete(self, *args, **kwargs):
+        # deleting never renumbers other trees
+        with self._write_lock(self.pk):
+            parent_id = self.parent_id
+            size = self._subtree_size()
+            result = super().delete(*args, **kwargs)
+            self._update_ancestor_counts(parent_id, -size)
+        return result
+
+    delete.alters_data = True
+
+
+class CategoryClosureManager(models.Manager):
+    def _link_subtree_sql(self) -> str:
+        closure = self.model._meta.db_table
+        return (
+            f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+            f"SELECT p.ancestor_id, s.descendant_id, p.depth + s.depth + 1 "
+            f"FROM {closure} p, {closure} s WHERE p.descendant_id = %s AND s.ancestor_id = %s"
+        )
+
+    def add_node(self, node: CategoryMPTT):
+        """links a freshly inserted leaf to itself and to all its ancestors"""
+        self.create(ancestor_id=node.pk, descendant_id=node.pk, depth=0)
+        if node.parent_id is not None:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(self._link_subtree_sql(), [node.parent_id, node.pk])
+
+    def move_subtree(self, node: CategoryMPTT):
+        """relinks the subtree of ``node`` after it has been moved below ``node.parent_id``"""
+        subtree = self.filter(ancestor_id=node.pk).values("descendant_id")
+        self.filter(descendant_id__in=subtree).exclude(ancestor_id__in=subtree).delete()
+        if node.parent_id is not None:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(self._link_subtree_sql(), [node.parent_id, node.pk])
+
+    @transaction.atomic
+    def rebuild(self, tree_ids: Optional[Iterable[int]] = None) -> int:
+        """recomputes the closure of the given trees (all trees by default) from the nested sets"""
+        closure = self.model._meta.db_table
+        nodes = CategoryMPTT._meta.db_table
+        params: List[int] = []
+        where = ""
+        if tree_ids is not None:
+            tree_ids = list(tree_ids)
+            if not tree_ids:
+                return 0
+            self.filter(descendant__tree_id__in=tree_ids).delete()
+            where = f" WHERE a.tree_id IN ({', '.join(['%s'] * len(tree_ids))})"
+            params = tree_ids
+        else:
+            self.all().delete()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+                f"SELECT a.id, d.id, d.level - a.level FROM {nodes} a "
+                f"JOIN {nodes} d ON d.tree_id = a.tree_id AND d.lft >= a.lft AND d.lft < a.rgt{where}",
+                params,
+            )
+            return cursor.rowcount
+
+
+class CategoryClosure(models.Model):
+    """
+    Optional closure-table projection of CategoryMPTT: one row per (ancestor, descendant) pair,
+    the node itself included with depth 0. Maintained by ``category.signals`` when
+    ``settings.CATEGORY_CLOSURE_ENABLED`` is set, repaired by the ``rebuild_closure`` command.
+    """
+
+    ancestor = models.ForeignKey(CategoryMPTT, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(CategoryMPTT, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.PositiveIntegerField()
+    objects = CategoryClosureManager()
+
+    class Meta:
+        db_table = get_table_name("category_closure")
+        constraints = [
+            models.UniqueConstraint(fields=["ancestor", "descendant"], name="category_closure_unique_pair"),
+        ]
+
+    def __str__(self):
+        return f'{self.ancestor_id} -> {self.descendant_id} ({self.depth})'
+
+    @staticmethod
+    def enabled() -> bool:
+        return getattr(settings, "CATEGORY_CLOSURE_ENABLED", False)
+
+
+class CategoryTreeBeardManager(MP_NodeManager):
+    """materialized path manager with batched moves and an optional ltree index on PostgreSQL"""
+
+    bulk_move_positions = ("last-child", "last-sibling")
+    # generated column added by the enable_ltree command
+    ltree_column = "path_ltree"
+
+    def uses_ltree(self) -> bool:
+        """``settings.CATEGORY_TREEBEARD_LTREE`` is set and the database is PostgreSQL"""
+        return getattr(settings, "CATEGORY_TREEBEARD_LTREE", False) and connections[self.db].vendor == "postgresql"
+
+    def ltree_label(self, path: str) -> str:
+        """``path`` as ltree labels, one per step: ``00010002`` -> ``0001.0002``"""
+        steplen = self.tree_model.steplen
+        return ".".join(path[pos:pos + steplen] for pos in range(0, len(path), steplen))
+
+    def _ltree_filter(self, operator: str, path: str):
+        table = connections[self.db].ops.quote_name(self.tree_model._meta.db_table)
+        column = connections[self.db].ops.quote_name(self.ltree_column)
+        return self.extra(where=[f"{table}.{column} {operator} %s::ltree"], params=[self.ltree_label(path)])
+
+    def get_tree(self, parent=None, max_depth: Optional[int] = None):
+        """``<@`` on the GiST index instead of a ``LIKE`` prefix scan when ltree is enabled"""
+        if parent is None or parent.is_leaf() or not self.uses_ltree():
+            return super().get_tree(parent, max_depth=max_depth)
+        queryset = self._ltree_filter("<@", parent.path)
+        if max_depth is not None:
+            queryset = queryset.filter(depth__lte=parent.depth + max_depth)
+        return queryset
+
+    def get_ancestors(self, node):
+        if node.is_root() or not self.uses_ltree():
+            return super().get_ancestors(node)
+        return self._ltree_filter("@>", node.path[:-self.tree_model.steplen]).order_by("depth")
+
+    def _last_child_step(self, parent_path: str) -> int:
+        """the step of the last child of ``parent_path`` ('' means the root level), 0 if there are none"""
+        model = self.tree_model
+        children = model.objects.filter(depth=len(parent_path) // model.steplen + 1)
+        if parent_path:
+            children = children.filter(path__range=model._get_children_path_interval(parent_path))
+        last = children.order_by("-path").values_list("path", flat=True).first()
+        return model._str2int(last[-model.steplen:]) if last else 0
+
+    @traced("treebeard.insert")
+    def add_root(self, *args, **kwargs):
+        return super().add_root(*args, **kwargs)
+
+    @traced("treebeard.insert")
+    def add_child(self, *args, **kwargs):
+        return super().add_child(*args, **kwargs)
+
+    @traced("treebeard.insert")
+    def add_sibling(self, *args, **kwargs):
+        return super().add_sibling(*args, **kwargs)
+
+    @traced("treebeard.move")
+    def move(self, *args, **kwargs):
+        return super().move(*args, **kwargs)
+
+    @traced("treebeard.bulk_move")
+    @transaction.atomic
+    def bulk_move(self, moves: Iterable[Tuple["CategoryTreeBeard", "CategoryTreeBeard", str]]) -> int:
+        """
+        Applies many ``(node, target, pos)`` moves in one transaction.
+
+        The moves are planned in memory: every node and target path is tracked through the
+        earlier moves of the batch, free child slots are looked up once per parent and
+        ``numchild`` is fixed with a single ``CASE`` update at the end. Each moved branch is
+        rewritten by one ``UPDATE`` of its path prefix. Only the appending positions
+        ``last-child`` and ``last-sibling`` are supported, they never shift other branches;
+        use ``move()`` for the rest. Returns the number of branches that were rewritten.
+        """
+        model = self.tree_model
+        steplen = model.steplen
+        max_length = model._meta.get_field("path").max_length
+        moves = list(moves)
+        for _, _, pos in moves:
+            if pos not in self.bulk_move_positions:
+                raise InvalidPosition(f"Invalid relative position for bulk_move: {pos}")
+
+        pks = {node.pk for node, _, _ in moves} | {target.pk for _, target, _ in moves}
+        paths: Dict[int, str] = dict(model.objects.filter(pk__in=pks).values_list("pk", "path"))
+        last_steps: Dict[str, int] = {}
+        numchild: Counter = Counter()
+
+        def rekey(mapping, old_prefix, new_prefix):
+            for key in [key for key in mapping if key.startswith(old_prefix)]:
+                mapping[new_prefix + key[len(old_prefix):]] = mapping.pop(key)
+
+        moved = 0
+        for node, target, pos in moves:
+            old_path = paths[node.pk]
+            target_path = paths[target.pk]
+            parent_path = target_path if pos == "last-child" else target_path[:-steplen]
+            if parent_path.startswith(old_path):
+                raise InvalidMoveToDescendant("Can't move node to a descendant.")
+
+            old_parent_path = old_path[:-steplen]
+            if parent_path not in last_steps:
+                last_steps[parent_path] = self._last_child_step(parent_path)
+            if parent_path == old_parent_path and model._str2int(old_path[-steplen:]) == last_steps[parent_path]:
+                # already the last child of the target parent
+                continue
+
+            step = last_steps[parent_path] + 1
+            key = model._int2str(step)
+            new_path = f"{parent_path}{model.alphabet[0] * (steplen - len(key))}{key}"
+            if len(key) > steplen or len(new_path) > max_length:
+                raise PathOverflow(f"Path Overflow from: '{old_path}'")
+
+            self._set_newpath_in_branches(old_path, new_path)
+            moved += 1
+            last_steps[parent_path] = step
+            if old_parent_path:
+                numchild[old_parent_path] -= 1
+            if parent_path:
+                numchild[parent_path] += 1
+
+            for pk, path in paths.items():
+                if path.startswith(old_path):
+                    paths[pk] = new_path + path[len(old_path):]
+            rekey(last_steps, old_path, new_path)
+            rekey(numchild, old_path, new_path)
+
+        changed = {path: delta for path, delta in numchild.items() if delta}
+        if changed:
+            model.objects.filter(path__in=changed).update(numchild=Case(
+                *[When(path=path, then=F("numchild") + delta) for path, delta in changed.items()],
+                default=F("numchild"),
+                output_field=models.PositiveIntegerField(),
+            ))
+
+        for node, target, _ in moves:
+            for item in (node, target):
+                item.path = paths[item.pk]
+                item.depth = len(item.path) // steplen
+        return moved
 
 
 class CategoryTreeBeard(MP_Node, CreateUpdateTracker):
@@ -86,9 +908,28 @@ class CategoryTreeBeard(MP_Node, CreateUpdateTracker):
     # id = models.AutoField(primary_key=True)
 
     name = models.CharField(max_length=256, unique=True)
+    objects = CategoryTreeBeardManager()
+
+    # see category.versioning
+    tree_key_field = "path"
+    tree_key_lookup = "path__startswith"
 
     class Meta:
         db_table = get_table_name("category_treebeard")
 
     def __str__(self):
         return f'{self.name}'
+
+    @property
+    def tree_key(self) -> str:
+        return self.path[:self.steplen]
+
+    @traced("treebeard.delete")
+    def delete(self, *args, **kwargs):
+        return super().delete(*args, **kwargs)
+
+    delete.alters_data = True
+
+    def get_breadcrumbs(self, include_self: bool = True) -> List[str]:
+        """names from the root down to this node, served from the per-process ancestor cache"""
+        return ancestor_cache.breadcrumbs(self, include_self=include_self)
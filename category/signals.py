@@ -0,0 +1,75 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from mptt.signals import node_moved
+from treebeard.mp_tree import path_updated
+
+from category.breadcrumbs import ancestor_cache
+from category.identity import current_identity_map
+from category.models import Category, CategoryClosure, CategoryMPTT, CategoryTreeBeard
+from category.versioning import bump_tree_version
+
+
+@receiver(post_save, sender=CategoryTreeBeard)
+@receiver(post_delete, sender=CategoryTreeBeard)
+def invalidate_breadcrumb_node(sender, instance, **kwargs):
+    ancestor_cache.invalidate(instance.path)
+
+
+@receiver(path_updated, sender=CategoryTreeBeard)
+def invalidate_breadcrumb_branch(sender, old_path, new_path, **kwargs):
+    """moves and sibling shifts rewrite whole branches with a single UPDATE"""
+    ancestor_cache.invalidate_prefix(old_path)
+    ancestor_cache.invalidate_prefix(new_path)
+
+
+@receiver(post_save, sender=CategoryMPTT)
+@receiver(post_delete, sender=CategoryMPTT)
+def bump_mptt_version(sender, instance, using, **kwargs):
+    # new or removed roots can renumber the tree_id of other trees
+    bump_tree_version(sender, instance.tree_id if instance.parent_id else None, using)
+
+
+@receiver(post_save, sender=CategoryTreeBeard)
+@receiver(post_delete, sender=CategoryTreeBeard)
+def bump_treebeard_version(sender, instance, using, **kwargs):
+    bump_tree_version(sender, instance.tree_key, using)
+
+
+@receiver(node_moved, sender=CategoryMPTT)
+@receiver(path_updated, sender=CategoryTreeBeard)
+def bump_moved_version(sender, **kwargs):
+    bump_tree_version(sender, using=kwargs.get("using"))
+
+
+@receiver(post_save, sender=Category)
+def sync_category_name(sender, instance, created, using, update_fields=None, **kwargs):
+    """copies a renamed category into CategoryMPTT.name with one UPDATE"""
+    if created or (update_fields is not None and "name" not in update_fields):
+        return
+    nodes = CategoryMPTT.objects.db_manager(using).filter(category=instance)
+    if nodes.exclude(name=instance.name).update(name=instance.name):
+        bump_tree_version(CategoryMPTT, using=using)
+
+
+@receiver(post_save, sender=CategoryMPTT)
+def link_closure_node(sender, instance, created, **kwargs):
+    if created and CategoryClosure.enabled():
+        CategoryClosure.objects.add_node(instance)
+
+
+@receiver(node_moved, sender=CategoryMPTT)
+def relink_closure_subtree(sender, instance, **kwargs):
+    # deletes need no handler, the closure rows cascade with their nodes
+    if CategoryClosure.enabled():
+        CategoryClosure.objects.move_subtree(instance)
+
+
+# only the models looked up through GetOrNoneManager, a receiver without a sender would
+# disable fast deletes of every model
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def forget_identity(sender, instance, **kwargs):
+    """a saved object may have changed the values it was looked up by"""
+    identity = current_identity_map()
+    if identity is not None:
+        identity.discard(instance)
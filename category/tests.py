@@ -1,9 +1,36 @@
 # tests.py
+import datetime
+import gzip
+import io
+import json
 import logging
+import os
+import tempfile
+import threading
+from unittest import mock
 
-from django.test import TestCase
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core.serializers.base import DeserializationError
+from django.db import DataError, connection, connections
+from django.db.models.deletion import Collector
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition
 
-from category.models import Category, CategoryMPTT, CategoryTreeBeard
+from category.breadcrumbs import ancestor_cache
+from category.bulk import _copy_text, allocate_ids, copy_objects, copy_rows, copy_supported
+from category.dump import dump_tree, iter_tree_json
+from category.identity import identity_map
+from category.instrumentation import get_sink, measure
+from category.management.commands.tree_bench import OPERATIONS
+from category.loading import iter_fixture, load_fixture
+from category.locks import _FileLock, tree_lock
+from category.models import Category, CategoryClosure, CategoryMPTT, CategoryMPTTManager, CategoryTreeBeard
+from category.transfer import table_path
+from category.versioning import check_tree_cache, tree_cache
 
 logger = logging.getLogger(__name__)
 
@@ -84,4 +111,1161 @@ class CategoryTreebeard_TestCase(TestCase):
 
         self.assertEqual('category_2', tree_node.name)
         tree_node.delete()
-        tree_root.delete()
\ No newline at end of file
+        tree_root.delete()
+
+
+class CategoryMPTTBulkLoad_TestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 8)])
+        self.ids = {category.name: category.id for category in Category.objects.all()}
+
+    def test_bulk_load_matches_mptt_inserts(self):
+        ids = self.ids
+        tree = {
+            ids["category_1"]: {
+                ids["category_3"]: {ids["category_4"]: None},
+                ids["category_2"]: {},
+            },
+            ids["category_5"]: {ids["category_6"]: {}},
+        }
+        created = CategoryMPTT.objects.bulk_load_tree(tree)
+        self.assertEqual(6, created)
+
+        loaded = {node.category_id: (node.lft, node.rgt, node.level, node.tree_id)
+                  for node in CategoryMPTT.objects.all()}
+        CategoryMPTT.objects.all().delete()
+
+        # the same tree through regular django-mptt inserts
+        root_1 = CategoryMPTT.objects.create(category_id=ids["category_1"])
+        node_3 = CategoryMPTT.objects.create(category_id=ids["category_3"], parent=root_1)
+        CategoryMPTT.objects.create(category_id=ids["category_2"], parent=root_1)
+        CategoryMPTT.objects.create(category_id=ids["category_4"], parent=node_3)
+        root_5 = CategoryMPTT.objects.create(category_id=ids["category_5"])
+        CategoryMPTT.objects.create(category_id=ids["category_6"], parent=root_5)
+        expected = {node.category_id: (node.lft, node.rgt, node.level, node.tree_id)
+                    for node in CategoryMPTT.objects.all()}
+
+        self.assertEqual(expected, loaded)
+
+    def test_bulk_load_adjacency_list(self):
+        ids = self.ids
+        CategoryMPTT.objects.bulk_load_tree([
+            (ids["category_2"], ids["category_1"]),
+            (ids["category_1"], None),
+        ])
+        child = CategoryMPTT.objects.get(category_id=ids["category_2"])
+        self.assertEqual(ids["category_1"], child.parent.category_id)
+        self.assertEqual((2, 3, 1), (child.lft, child.rgt, child.level))
+
+    def test_bulk_load_rejects_cycles(self):
+        ids = self.ids
+        with self.assertRaises(ValueError):
+            CategoryMPTT.objects.bulk_load_tree([
+                (ids["category_1"], ids["category_2"]),
+                (ids["category_2"], ids["category_1"]),
+            ])
+        self.assertEqual(0, CategoryMPTT.objects.count())
+
+
+class CategoryMPTTIterSubtree_TestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 8)])
+        ids = [category.id for category in Category.objects.order_by("id")]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}, ids[3]: {}}, ids[4]: {ids[5]: {}}},
+                                             ids[6]: {}})
+        self.root = CategoryMPTT.objects.get(category_id=ids[0])
+
+    def test_iter_subtree_in_lft_order(self):
+        expected = [(node.pk, node.parent_id, node.level) for node in self.root.get_descendants()]
+        rows = list(CategoryMPTT.objects.iter_subtree(self.root, chunk_size=2))
+        self.assertEqual(expected, [(row.id, row.parent_id, row.depth) for row in rows])
+
+    def test_iter_subtree_include_self(self):
+        rows = list(CategoryMPTT.objects.iter_subtree(self.root, chunk_size=4, include_self=True))
+        self.assertEqual(6, len(rows))
+        self.assertEqual((self.root.pk, 0), (rows[0].id, rows[0].depth))
+
+
+class CategoryTreebeardBreadcrumbs_TestCase(TestCase):
+    def setUp(self):
+        ancestor_cache.clear()
+        self.root = CategoryTreeBeard.add_root(name="category_1")
+        self.child = CategoryTreeBeard.add_child(self.root, name="category_2")
+        self.leaf = CategoryTreeBeard.add_child(self.child, name="category_3")
+
+    def test_breadcrumbs_are_served_from_cache(self):
+        self.assertEqual(["category_1", "category_2", "category_3"], self.leaf.get_breadcrumbs())
+        with self.assertNumQueries(0):
+            self.assertEqual(["category_1", "category_2"], self.leaf.get_breadcrumbs(include_self=False))
+
+    def test_rename_invalidates_cache(self):
+        self.leaf.get_breadcrumbs()
+        self.child.name = "category_2_renamed"
+        self.child.save()
+        self.assertEqual(["category_1", "category_2_renamed", "category_3"], self.leaf.get_breadcrumbs())
+
+    def test_move_invalidates_cache(self):
+        other_root = CategoryTreeBeard.add_root(name="category_4")
+        self.leaf.get_breadcrumbs()
+        self.child.move(other_root, "last-child")
+        self.leaf.refresh_from_db()
+        self.assertEqual(["category_4", "category_2", "category_3"], self.leaf.get_breadcrumbs())
+
+
+class CategoryTreeAPI_TestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 4)])
+        ids = [category.id for category in Category.objects.order_by("id")]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}}})
+        self.mptt_root = CategoryMPTT.objects.get(category_id=ids[0])
+        self.mptt_leaf = CategoryMPTT.objects.get(category_id=ids[2])
+
+        self.tb_root = CategoryTreeBeard.add_root(name="category_1")
+        self.tb_leaf = CategoryTreeBeard.add_child(CategoryTreeBeard.add_child(self.tb_root, name="category_2"),
+                                                   name="category_3")
+
+    def test_mptt_endpoints(self):
+        response = self.client.get(reverse("category:subtree", args=["mptt", self.mptt_root.pk]))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["category_2", "category_3"], [item["name"] for item in response.json()["results"]])
+
+        response = self.client.get(reverse("category:ancestors", args=["mptt", self.mptt_leaf.pk]))
+        self.assertEqual(["category_1", "category_2"], [item["name"] for item in response.json()["results"]])
+
+        response = self.client.get(reverse("category:children", args=["mptt", self.mptt_root.pk]))
+        self.assertEqual(["category_2"], [item["name"] for item in response.json()["results"]])
+
+    def test_treebeard_endpoints(self):
+        response = self.client.get(reverse("category:subtree", args=["treebeard", self.tb_root.pk]))
+        self.assertEqual(["category_2", "category_3"], [item["name"] for item in response.json()["results"]])
+
+        response = self.client.get(reverse("category:ancestors", args=["treebeard", self.tb_leaf.pk]))
+        self.assertEqual(["category_1", "category_2"], [item["name"] for item in response.json()["results"]])
+
+    def test_unknown_node(self):
+        response = self.client.get(reverse("category:children", args=["mptt", 0]))
+        self.assertEqual(404, response.status_code)
+        response = self.client.get(reverse("category:children", args=["unknown", self.mptt_root.pk]))
+        self.assertEqual(404, response.status_code)
+
+
+class CategoryMPTTCounts_TestCase(TestCase):
+    def setUp(self):
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 7)])
+
+    def counts(self):
+        return {node.category.name: (node.child_count, node.descendant_count)
+                for node in CategoryMPTT.objects.select_related("category")}
+
+    def create(self, index, parent=None):
+        return CategoryMPTT.objects.create(category=self.categories[index], parent=parent)
+
+    def test_counts_follow_insert_move_delete(self):
+        root = self.create(0)
+        node_2 = self.create(1, root)
+        node_3 = self.create(2, node_2)
+        self.create(3, node_3)
+        other_root = self.create(4)
+        self.assertEqual((1, 3), self.counts()["category_1"])
+        self.assertEqual((1, 2), self.counts()["category_2"])
+
+        node_3 = CategoryMPTT.objects.get(pk=node_3.pk)
+        node_3.parent = other_root
+        node_3.save()
+        counts = self.counts()
+        self.assertEqual((1, 1), counts["category_1"])
+        self.assertEqual((0, 0), counts["category_2"])
+        self.assertEqual((1, 2), counts["category_5"])
+
+        node_2 = CategoryMPTT.objects.get(pk=node_2.pk)
+        node_2.move_to(CategoryMPTT.objects.get(pk=other_root.pk), "last-child")
+        counts = self.counts()
+        self.assertEqual((0, 0), counts["category_1"])
+        self.assertEqual((2, 3), counts["category_5"])
+
+        CategoryMPTT.objects.get(pk=node_3.pk).delete()
+        self.assertEqual((1, 1), self.counts()["category_5"])
+
+    def test_stale_instance_does_not_overwrite_counts(self):
+        root = self.create(0)
+        self.create(1, root)
+        root.save()
+        self.assertEqual((1, 1), self.counts()["category_1"])
+
+    def test_rebuild_counts(self):
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}})
+        expected = self.counts()
+        self.assertEqual((2, 3), expected["category_1"])
+        CategoryMPTT.objects.update(child_count=0, descendant_count=0)
+        call_command("rebuild_counts", verbosity=0)
+        self.assertEqual(expected, self.counts())
+
+
+class CategoryTreebeardBulkMove_TestCase(TestCase):
+    def setUp(self):
+        self.root_1 = CategoryTreeBeard.add_root(name="category_1")
+        self.root_2 = CategoryTreeBeard.add_root(name="category_2")
+        self.node_3 = CategoryTreeBeard.add_child(self.root_1, name="category_3")
+        self.node_4 = CategoryTreeBeard.add_child(self.node_3, name="category_4")
+        self.node_5 = CategoryTreeBeard.add_child(self.root_1, name="category_5")
+        self.node_6 = CategoryTreeBeard.add_child(self.root_2, name="category_6")
+
+    def tree(self):
+        by_path = {node.path: node.name for node in CategoryTreeBeard.objects.all()}
+        return {name: by_path.get(path[:-CategoryTreeBeard.steplen]) for path, name in by_path.items()}
+
+    def test_bulk_move(self):
+        moved = CategoryTreeBeard.objects.bulk_move([
+            (self.node_3, self.root_2, "last-child"),
+            (self.node_6, self.node_4, "last-child"),
+            (self.node_5, self.root_2, "last-sibling"),
+        ])
+        self.assertEqual(3, moved)
+        self.assertEqual({
+            "category_1": None,
+            "category_2": None,
+            "category_3": "category_2",
+            "category_4": "category_3",
+            "category_6": "category_4",
+            "category_5": None,
+        }, self.tree())
+        self.assertEqual(([], [], [], [], []), CategoryTreeBeard.objects.find_problems())
+        self.assertEqual(4, self.node_6.depth)
+
+    def test_bulk_move_into_descendant(self):
+        with self.assertRaises(InvalidMoveToDescendant):
+            CategoryTreeBeard.objects.bulk_move([(self.root_1, self.node_4, "last-child")])
+        self.assertEqual("category_1", self.tree()["category_3"])
+
+    def test_bulk_move_rejects_shifting_positions(self):
+        with self.assertRaises(InvalidPosition):
+            CategoryTreeBeard.objects.bulk_move([(self.node_3, self.root_2, "first-child")])
+
+
+class TreeInstrumentation_TestCase(TestCase):
+    def setUp(self):
+        # the versions are bumped on commit, never in these rolled back tests
+        tree_cache().clear()
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 3)])
+
+    def test_spans_count_tree_queries(self):
+        cat1, cat2 = Category.objects.order_by("id")
+        with measure() as metrics:
+            root = CategoryMPTT.objects.create(category=cat1)
+            CategoryMPTT.objects.create(category=cat2, parent=root)
+            CategoryTreeBeard.add_root(name="category_1")
+        self.assertEqual(2, metrics.spans["mptt.insert"].calls)
+        self.assertEqual(1, metrics.spans["treebeard.insert"].calls)
+        self.assertGreater(metrics.queries, 0)
+        self.assertLessEqual(sum(span.queries for span in metrics.spans.values()), metrics.queries)
+
+    @override_settings(CATEGORY_METRICS={"SINK": "category.instrumentation.RingBufferSink"})
+    def test_middleware_reports_to_sink(self):
+        get_sink.cache_clear()
+        self.addCleanup(get_sink.cache_clear)
+        root = CategoryMPTT.objects.create(category=Category.objects.first())
+        self.client.get(reverse("category:subtree", args=["mptt", root.pk]))
+        report = get_sink().snapshot()[-1]
+        self.assertEqual(200, report["status"])
+        self.assertEqual(1, report["spans"]["mptt.get_descendants"]["calls"])
+        self.assertGreaterEqual(report["queries"], 1)
+
+    @override_settings(CATEGORY_METRICS={"SINK": "category.instrumentation.RingBufferSink"})
+    def test_middleware_reports_streaming_responses_after_the_body(self):
+        get_sink.cache_clear()
+        self.addCleanup(get_sink.cache_clear)
+        CategoryMPTT.objects.create(category=Category.objects.first())
+        response = self.client.get(reverse("category:dump", args=["mptt"]))
+        self.assertEqual([], get_sink().snapshot())
+        self.assertIn(b"category_1", b"".join(response.streaming_content))
+        report = get_sink().snapshot()[-1]
+        self.assertEqual(200, report["status"])
+        # the forest is read while the body streams
+        self.assertGreaterEqual(report["queries"], 1)
+
+    @override_settings(CATEGORY_METRICS={"SINK": "category.instrumentation.RingBufferSink"})
+    async def test_middleware_counts_async_view_queries(self):
+        """the ORM calls of async views run in another thread, on another connection object"""
+        get_sink.cache_clear()
+        self.addCleanup(get_sink.cache_clear)
+        root = await CategoryMPTT.objects.acreate(category=await Category.objects.afirst())
+        response = await self.async_client.get(reverse("category:children", args=["mptt", root.pk]))
+        self.assertEqual(200, response.status_code)
+        report = get_sink().snapshot()[-1]
+        self.assertGreaterEqual(report["queries"], 2)
+        self.assertGreater(report["sql_seconds"], 0)
+
+
+class DumpTree_TestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 6)])
+        ids = [category.id for category in Category.objects.order_by("id")]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}, ids[4]: {}})
+        self.root = CategoryMPTT.objects.get(category_id=ids[0])
+
+        tb_root = CategoryTreeBeard.add_root(name="category_1")
+        CategoryTreeBeard.add_child(CategoryTreeBeard.add_child(tb_root, name="category_2"), name="category_3")
+        CategoryTreeBeard.add_root(name="category_4")
+
+    @staticmethod
+    def names(forest):
+        return [(node["name"], DumpTree_TestCase.names(node["children"])) for node in forest]
+
+    def test_dump_mptt_in_one_query(self):
+        with self.assertNumQueries(1):
+            forest = dump_tree()
+        self.assertEqual([
+            ("category_1", [("category_2", [("category_3", [])]), ("category_4", [])]),
+            ("category_5", []),
+        ], self.names(forest))
+        self.assertEqual([("category_1", [("category_2", []), ("category_4", [])])],
+                         self.names(dump_tree(self.root, max_depth=1)))
+
+    def test_dump_treebeard(self):
+        with self.assertNumQueries(1):
+            forest = dump_tree(model=CategoryTreeBeard)
+        self.assertEqual([("category_1", [("category_2", [("category_3", [])])]), ("category_4", [])],
+                         self.names(forest))
+
+    def test_streamed_json_matches_dump(self):
+        for model in (CategoryMPTT, CategoryTreeBeard):
+            self.assertEqual(dump_tree(model=model), json.loads("".join(iter_tree_json(model=model))))
+        self.assertEqual([], json.loads("".join(iter_tree_json(self.root, fields=["id"], max_depth=0)))[0]["children"])
+
+    def test_dump_endpoint(self):
+        response = self.client.get(reverse("category:dump", args=["mptt"]), {"max_depth": 0})
+        self.assertEqual(["category_1", "category_5"],
+                         [node["name"] for node in json.loads(b"".join(response.streaming_content))])
+        url = reverse("category:dump", args=["mptt"])
+        for root in ("abc", "1.5", "99999999999999999999999"):
+            self.assertEqual(400, self.client.get(url, {"root": root}).status_code)
+        self.assertEqual(404, self.client.get(url, {"root": 10 ** 6}).status_code)
+
+
+class TreeVersioning_TestCase(TestCase):
+    def setUp(self):
+        tree_cache().clear()
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 4)])
+        self.root = CategoryMPTT.objects.create(category=self.categories[0])
+        self.other_root = CategoryMPTT.objects.create(category=self.categories[1])
+
+    def test_conditional_requests_skip_the_database(self):
+        url = reverse("category:subtree", args=["mptt", self.root.pk])
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertTrue(response.headers["Last-Modified"])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(etag, response.headers["ETag"])
+
+    def test_writes_change_the_etag(self):
+        url = reverse("category:subtree", args=["mptt", self.root.pk])
+        other_url = reverse("category:subtree", args=["mptt", self.other_root.pk])
+        etag = self.client.get(url).headers["ETag"]
+        other_etag = self.client.get(other_url).headers["ETag"]
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            CategoryMPTT.objects.create(category=self.categories[2], parent=self.root)
+        # not committed yet: readers on other connections still see the old rows
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        for callback in callbacks:
+            callback()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["category_3"], [item["name"] for item in response.json()["results"]])
+        # the other tree was not touched
+        self.assertEqual(304, self.client.get(other_url, HTTP_IF_NONE_MATCH=other_etag).status_code)
+
+    def test_rebuild_counts_changes_the_etag(self):
+        url = reverse("category:subtree", args=["mptt", self.root.pk])
+        etag = self.client.get(url).headers["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("rebuild_counts", tree_ids=[self.root.tree_id], verbosity=0)
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_streamed_dump_is_cached_per_version(self):
+        url = reverse("category:dump", args=["treebeard"])
+        CategoryTreeBeard.add_root(name="category_1")
+        first = b"".join(self.client.get(url).streaming_content)
+        with self.assertNumQueries(0):
+            self.assertEqual(first, self.client.get(url).content)
+        with self.captureOnCommitCallbacks(execute=True):
+            CategoryTreeBeard.add_root(name="category_2")
+        self.assertIn(b"category_2", b"".join(self.client.get(url).streaming_content))
+
+    def test_unknown_query_params_share_the_cached_response(self):
+        url = reverse("category:dump", args=["treebeard"])
+        CategoryTreeBeard.add_root(name="category_1")
+        first = b"".join(self.client.get(url, {"max_depth": 1}).streaming_content)
+        with self.assertNumQueries(0):
+            self.assertEqual(first, self.client.get(url, {"max_depth": 1, "nonce": "1"}).content)
+        # a parameter the view reads has an entry of its own
+        self.assertTrue(self.client.get(url, {"max_depth": 2}).streaming)
+
+    @override_settings(CATEGORY_TREE_CACHE_SINGLE_PROCESS=False)
+    def test_process_local_cache_disables_versioning(self):
+        self.assertEqual(["category.W001"], [warning.id for warning in check_tree_cache(None)])
+        url = reverse("category:subtree", args=["mptt", self.root.pk])
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn("ETag", response.headers)
+
+
+@override_settings(CATEGORY_CLOSURE_ENABLED=True)
+class CategoryClosure_TestCase(TestCase):
+    def setUp(self):
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 7)])
+
+    def create(self, index, parent=None):
+        return CategoryMPTT.objects.create(category=self.categories[index], parent=parent)
+
+    @staticmethod
+    def links():
+        return set(CategoryClosure.objects.values_list("ancestor_id", "descendant_id", "depth"))
+
+    @staticmethod
+    def expected():
+        return {(ancestor.pk, node.pk, node.level - ancestor.level)
+                for node in CategoryMPTT.objects.all()
+                for ancestor in node.get_ancestors(include_self=True)}
+
+    def test_closure_follows_insert_move_delete(self):
+        root = self.create(0)
+        node_2 = self.create(1, root)
+        node_3 = self.create(2, node_2)
+        self.create(3, node_3)
+        other_root = self.create(4)
+        self.assertEqual(self.expected(), self.links())
+
+        node_3 = CategoryMPTT.objects.get(pk=node_3.pk)
+        node_3.parent = other_root
+        node_3.save()
+        self.assertEqual(self.expected(), self.links())
+
+        CategoryMPTT.objects.get(pk=node_2.pk).move_to(CategoryMPTT.objects.get(pk=node_3.pk), "first-child")
+        self.assertEqual(self.expected(), self.links())
+
+        CategoryMPTT.objects.get(pk=node_3.pk).move_to(None)
+        self.assertEqual(self.expected(), self.links())
+
+        CategoryMPTT.objects.get(pk=node_3.pk).delete()
+        self.assertEqual(self.expected(), self.links())
+
+    def test_rebuild_closure_and_under_any(self):
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}, ids[4]: {ids[5]: {}}})
+        expected = self.expected()
+        self.assertEqual(expected, self.links())
+        CategoryClosure.objects.all().delete()
+        call_command("rebuild_closure", verbosity=0)
+        self.assertEqual(expected, self.links())
+
+        nodes = {node.category_id: node for node in CategoryMPTT.objects.all()}
+        under = [nodes[ids[1]], nodes[ids[4]]]
+        expected = {ids[1], ids[2], ids[4], ids[5]}
+        self.assertEqual(expected, set(CategoryMPTT.objects.under_any(under).values_list("category_id", flat=True)))
+        with override_settings(CATEGORY_CLOSURE_ENABLED=False):
+            self.assertEqual(expected,
+                             set(CategoryMPTT.objects.under_any(under).values_list("category_id", flat=True)))
+        self.assertEqual({ids[2], ids[5]}, set(CategoryMPTT.objects.under_any(under, include_self=False)
+                                               .values_list("category_id", flat=True)))
+
+
+class CategoryTreebeardLtree_TestCase(TestCase):
+    def setUp(self):
+        """a root with a child and a grandchild"""
+        self.root = CategoryTreeBeard.add_root(name="root")
+        self.child = CategoryTreeBeard.add_child(self.root, name="child")
+        self.grandchild = CategoryTreeBeard.add_child(self.child, name="grandchild")
+
+    def test_ltree_label(self):
+        self.assertEqual("0001.0001.0001", CategoryTreeBeard.objects.ltree_label(self.grandchild.path))
+
+    @override_settings(CATEGORY_TREEBEARD_LTREE=True)
+    def test_falls_back_without_postgresql(self):
+        self.assertFalse(CategoryTreeBeard.objects.uses_ltree())
+        self.root.refresh_from_db()
+        self.assertEqual(["child", "grandchild"],
+                         [node.name for node in CategoryTreeBeard.objects.get_descendants(self.root)])
+        self.assertEqual(["root", "child"],
+                         [node.name for node in CategoryTreeBeard.objects.get_ancestors(self.grandchild)])
+        self.assertTrue(self.grandchild.is_descendant_of(self.root))
+        with self.assertRaises(CommandError):
+            call_command("enable_ltree", verbosity=0)
+
+
+class CategoryMPTTCheckTree_TestCase(TestCase):
+    def setUp(self):
+        """two trees loaded in bulk: 1 -> (2 -> 3, 4) and 5 -> 6"""
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 7)])
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}, ids[4]: {ids[5]: {}}})
+        self.nodes = {node.category.name: node for node in CategoryMPTT.objects.select_related("category")}
+
+    @staticmethod
+    def snapshot():
+        return list(CategoryMPTT.objects.order_by("pk").values_list(
+            "tree_id", "lft", "rgt", "level", "child_count", "descendant_count"))
+
+    def test_consistent_trees(self):
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+
+    def test_repairs_only_broken_tree(self):
+        expected = self.snapshot()
+        CategoryMPTT.objects.filter(pk=self.nodes["category_3"].pk).update(lft=10, rgt=11)
+        CategoryMPTT.objects.filter(pk=self.nodes["category_1"].pk).update(level=1, descendant_count=0)
+        # the wrong root level spreads to its children
+        self.assertEqual({self.nodes["category_1"].tree_id: 4}, CategoryMPTT.objects.check_trees())
+
+        out = io.StringIO()
+        call_command("check_tree", dry_run=True, stdout=out)
+        self.assertIn(f"tree {self.nodes['category_1'].tree_id}: 4 inconsistent nodes", out.getvalue())
+        self.assertNotEqual(expected, self.snapshot())
+
+        call_command("check_tree", stdout=out)
+        self.assertEqual(expected, self.snapshot())
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+
+    def test_node_in_wrong_tree_and_extra_root(self):
+        node_6 = self.nodes["category_6"]
+        CategoryMPTT.objects.filter(pk=node_6.pk).update(tree_id=self.nodes["category_1"].tree_id)
+        self.assertEqual({self.nodes["category_1"].tree_id, self.nodes["category_5"].tree_id},
+                         set(CategoryMPTT.objects.check_trees()))
+        CategoryMPTT.objects.filter(pk=self.nodes["category_5"].pk).update(tree_id=self.nodes["category_1"].tree_id)
+        tree_ids = CategoryMPTT.objects.repair_trees(CategoryMPTT.objects.check_trees())
+        self.assertEqual(2, len(tree_ids))
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+
+    def test_cyclic_parents_are_reported(self):
+        root = self.nodes["category_1"]
+        child = CategoryMPTT.objects.filter(parent=root).first()
+        CategoryMPTT.objects.filter(pk=root.pk).update(parent=child, lft=10)
+        with self.assertRaisesMessage(CommandError, f"Cannot repair trees {root.tree_id}: nodes not reachable"):
+            call_command("check_tree", stdout=io.StringIO())
+
+
+class TreeLock_TestCase(TestCase):
+    def test_file_lock_is_reentrant_and_exclusive(self):
+        lock = _FileLock(os.path.join(tempfile.gettempdir(), "category-tree-test.lock"))
+        acquired = threading.Event()
+
+        def other():
+            lock.acquire()
+            acquired.set()
+            lock.release()
+
+        lock.acquire()
+        lock.acquire()
+        thread = threading.Thread(target=other)
+        thread.start()
+        lock.release()
+        self.assertFalse(acquired.wait(0.1))
+        lock.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_sequential_locked_writes_keep_trees_consistent(self):
+        categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 6)])
+        with tree_lock(CategoryMPTT):
+            root = CategoryMPTT.objects.create(category=categories[0])
+            child = CategoryMPTT.objects.create(category=categories[1], parent=root)
+        other = CategoryMPTT.objects.create(category=categories[2])
+        CategoryMPTT.objects.create(category=categories[3], parent=child)
+        CategoryMPTT.objects.get(pk=child.pk).move_to(CategoryMPTT.objects.get(pk=other.pk), "last-child")
+        CategoryMPTT.objects.get(pk=root.pk).delete()
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(3, CategoryMPTT.objects.count())
+
+
+class TreeLockConcurrency_TestCase(TransactionTestCase):
+    def test_concurrent_writers_keep_trees_consistent(self):
+        categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 42)])
+        roots = [CategoryMPTT.objects.create(category=category) for category in categories[:2]]
+        errors = []
+
+        def writer(number):
+            try:
+                for i in range(number, 39, 4):
+                    if i % 8 == 0:
+                        # a new root in the middle of child inserts takes the exclusive forest lock
+                        CategoryMPTT.objects.create(category=categories[2 + i])
+                    else:
+                        CategoryMPTT.objects.create(category=categories[2 + i], parent=roots[i % 2])
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=writer, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(41, CategoryMPTT.objects.count())
+        self.assertEqual(
+            [15, 19], [CategoryMPTT.objects.get(pk=root.pk).descendant_count for root in roots])
+
+    def test_inserts_follow_a_subtree_moved_between_trees(self):
+        categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 25)])
+        roots = [CategoryMPTT.objects.create(category=category) for category in categories[:2]]
+        branch = CategoryMPTT.objects.create(category=categories[2], parent=roots[0])
+        errors = []
+
+        def mover():
+            try:
+                for i in range(10):
+                    # no tree ids, only the reads of SQLite's shared in-memory test database need a lock
+                    with tree_lock(CategoryMPTT, []):
+                        CategoryMPTT.objects.get(pk=branch.pk).move_to(
+                            CategoryMPTT.objects.get(pk=roots[(i + 1) % 2].pk), "last-child")
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        def inserter(number):
+            try:
+                # the tree of the parent is looked up again once its lock is held
+                for category in categories[3 + number::3]:
+                    CategoryMPTT.objects.create(category=category, parent_id=branch.pk)
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=mover)] + [
+            threading.Thread(target=inserter, args=(number,)) for number in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(21, CategoryMPTT.objects.get(pk=branch.pk).descendant_count)
+        self.assertEqual([22, 0], [CategoryMPTT.objects.get(pk=root.pk).descendant_count for root in roots])
+
+
+@override_settings(CATEGORY_MPTT_GAP=9)
+class CategoryMPTTSparse_TestCase(TestCase):
+    def setUp(self):
+        """1 -> (3 -> 4, 7) and 8 loaded in bulk with a step of 10"""
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 10)])
+        self.ids = [category.id for category in self.categories]
+        ids = self.ids
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[2]: {ids[3]: {}}, ids[6]: {}}, ids[7]: {}})
+        self.nodes = {node.category_id: node for node in CategoryMPTT.objects.all()}
+
+    def dfs(self):
+        return list(CategoryMPTT.objects.order_by("tree_id", "lft").values_list("category_id", flat=True))
+
+    def test_bulk_load_is_spaced(self):
+        root = self.nodes[self.ids[0]]
+        self.assertEqual((1, 71, 3), (root.lft, root.rgt, root.get_descendant_count()))
+        self.assertTrue(self.nodes[self.ids[3]].is_leaf_node())
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertNotEqual({}, CategoryMPTT.objects.check_trees(sparse=False))
+
+    def test_insert_takes_free_slot(self):
+        untouched = list(CategoryMPTT.objects.order_by("pk").values_list("pk", "lft", "rgt"))
+        ids = self.ids
+        parent = self.nodes[ids[0]]
+        for index in (1, 4, 8):
+            CategoryMPTT.objects.create(category=self.categories[index], parent=parent)
+        CategoryMPTT.objects.create(category=self.categories[5], parent=self.nodes[ids[3]])
+        # none of the existing rows moved
+        self.assertEqual(untouched, list(CategoryMPTT.objects.filter(pk__in=[pk for pk, _, _ in untouched])
+                                         .order_by("pk").values_list("pk", "lft", "rgt")))
+        self.assertEqual([ids[0], ids[1], ids[2], ids[3], ids[5], ids[4], ids[6], ids[8], ids[7]], self.dfs())
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(7, CategoryMPTT.objects.get(pk=parent.pk).get_descendant_count())
+
+    def test_makes_room_when_gap_runs_out(self):
+        node = self.nodes[self.ids[7]]
+        for category in self.categories[8:]:
+            node = CategoryMPTT.objects.create(category=category, parent=node)
+        for index in (1, 4, 5):
+            CategoryMPTT.objects.create(category=self.categories[index], parent=self.nodes[self.ids[3]])
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(3, CategoryMPTT.objects.get(pk=self.nodes[self.ids[3]].pk).child_count)
+        leaves = CategoryMPTT.objects.get(pk=self.nodes[self.ids[0]].pk).get_leafnodes()
+        self.assertEqual({self.ids[1], self.ids[4], self.ids[5], self.ids[6]},
+                         set(leaves.values_list("category_id", flat=True)))
+
+    def test_insert_after_siblings_moved_out_of_order(self):
+        ids = self.ids
+        self.nodes[ids[6]].move_to(self.nodes[ids[2]], "left")
+        CategoryMPTT.objects.create(category=self.categories[4], parent=self.nodes[ids[0]])
+        CategoryMPTT.objects.create(category=self.categories[1], parent=self.nodes[ids[0]])
+        # the new nodes follow the last sibling with a lower category_id in lft order
+        self.assertEqual([ids[0], ids[1], ids[6], ids[2], ids[3], ids[4], ids[7]], self.dfs())
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual(5, CategoryMPTT.objects.get(pk=self.nodes[ids[0]].pk).descendant_count)
+
+    @override_settings(CATEGORY_MPTT_GAP=1000)
+    def test_appends_spread_the_parent_instead_of_the_tree(self):
+        ids = self.ids
+        CategoryMPTT.objects.all().delete()
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {}, ids[2]: {ids[3]: {}}}})
+        categories = Category.objects.bulk_create([Category(name=f"appended_{i}") for i in range(60)])
+        parent = CategoryMPTT.objects.get(category_id=ids[1])
+        other = CategoryMPTT.objects.filter(category_id__in=ids[2:4]).order_by("pk").values_list("lft", "rgt")
+        untouched = list(other)
+        with mock.patch.object(CategoryMPTTManager, "_renumber", autospec=True) as renumber, \
+                mock.patch.object(CategoryMPTTManager, "_make_room", autospec=True,
+                                  side_effect=CategoryMPTTManager._make_room) as make_room:
+            for category in categories:
+                CategoryMPTT.objects.create(category=category, parent=parent)
+        # the room doubles with every spread, the sibling subtree and the rest of the tree stay put
+        self.assertFalse(renumber.called)
+        self.assertLessEqual(make_room.call_count, 5)
+        self.assertEqual(untouched, list(other))
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+        self.assertEqual([category.id for category in categories],
+                         list(CategoryMPTT.objects.filter(parent=parent).order_by("lft")
+                              .values_list("category_id", flat=True)))
+
+
+class CategoryTreeAdmin_TestCase(TestCase):
+    def setUp(self):
+        """three roots, the first one with two children, and a logged in superuser"""
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 6)])
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[3]: {}, ids[4]: {}}, ids[1]: {}, ids[2]: {}})
+        self.nodes = {node.category.name: node for node in CategoryMPTT.objects.select_related("category")}
+        user = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(user)
+        self.url = reverse("admin:category_categorymptt_tree_json")
+        self.model_admin = admin.site._registry[CategoryMPTT]
+
+    def test_roots_then_one_level(self):
+        self.assertEqual(200, self.client.get(reverse("admin:category_categorymptt_changelist")).status_code)
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        roots = response.json()
+        self.assertEqual(["category_1", "category_2", "category_3"], [node["name"] for node in roots])
+        self.assertEqual([True, False, False], [node["load_on_demand"] for node in roots])
+
+        children = self.client.get(self.url, {"node": roots[0]["id"]}).json()
+        self.assertEqual(["category_4", "category_5"], [node["name"] for node in children])
+
+    def test_wide_levels_are_paged(self):
+        self.model_admin.tree_page_size = 1
+        try:
+            first = self.client.get(self.url).json()
+            # the other pages are siblings of the first one, not children of a "more" node
+            self.assertEqual(["category_1", "2–2 of 3", "3–3 of 3"], [node["name"] for node in first])
+            self.assertEqual(["@1", "@2"], [node["id"] for node in first[1:]])
+            self.assertTrue(all(node["load_on_demand"] and node["move_url"] for node in first[1:]))
+            rest = self.client.get(self.url, {"node": first[2]["id"]}).json()
+            self.assertEqual(["category_3"], [node["name"] for node in rest])
+            moved = self.client.post(first[0]["move_url"], {"target_id": "@1", "position": "inside"})
+            self.assertEqual(400, moved.status_code)
+        finally:
+            del self.model_admin.tree_page_size
+        self.assertEqual(400, self.client.get(self.url, {"node": "x@y"}).status_code)
+        self.assertEqual(404, self.client.get(self.url, {"node": "0"}).status_code)
+
+    def test_changelist_filters_apply(self):
+        root = self.nodes["category_1"]
+        self.assertEqual([], self.client.get(self.url, {"node": root.pk, "level": 0}).json())
+        children = self.client.get(self.url, {"node": root.pk, "level": 1}).json()
+        self.assertEqual(["category_4", "category_5"], [node["name"] for node in children])
+        self.assertIn("_changelist_filters=level%3D1", children[0]["url"])
+        self.assertIn("/move/", children[0]["move_url"])
+
+
+class CategoryAdminQueries_TestCase(TestCase):
+    def setUp(self):
+        """a logged in superuser"""
+        user = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(user)
+
+    def grow(self, size, category=None):
+        """a root with ``size`` children, ``category`` (the root's by default) is linked again below each"""
+        start = Category.objects.count()
+        categories = Category.objects.bulk_create([Category(name=f"category_{start + i}") for i in range(size)])
+        category = category or categories[0]
+        root = CategoryMPTT.objects.create(category=categories[0])
+        for other in categories[1:]:
+            child = CategoryMPTT.objects.create(category=other, parent=root)
+            CategoryMPTT.objects.create(category=category, parent=child)
+        return category
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(200, self.client.get(url).status_code)
+        return len(queries)
+
+    def test_constant_queries(self):
+        category = self.grow(3)
+        change = reverse("admin:category_category_change", args=[category.pk])
+        pages = [
+            change,
+            reverse("admin:category_category_changelist"),
+            reverse("admin:category_categorymptt_grid"),
+            reverse("admin:category_categorymptt_change", args=[CategoryMPTT.objects.last().pk]),
+        ]
+        # warm up the per-process caches (content types, ...)
+        for url in pages:
+            self.client.get(url)
+        small = [self.count_queries(url) for url in pages]
+        self.grow(30, category)
+        self.assertEqual(small, [self.count_queries(url) for url in pages])
+
+    def test_relations_are_raw_ids(self):
+        category = self.grow(3)
+        node = CategoryMPTT.objects.filter(category=category, parent__isnull=False).first()
+        for url in (reverse("admin:category_category_change", args=[category.pk]),
+                    reverse("admin:category_categorymptt_change", args=[node.pk])):
+            content = self.client.get(url).content.decode()
+            self.assertIn("vForeignKeyRawIdAdminField", content)
+            self.assertNotIn("<option", content)
+            # the parent's name labels its id
+            self.assertIn(f">{node.parent.name}</a></strong>", content)
+
+    def test_inline_nodes_are_saved_under_the_forest_lock(self):
+        category = self.grow(2)
+        url = reverse("admin:category_category_change", args=[category.pk])
+        formset = self.client.get(url).context["inline_admin_formsets"][0].formset
+        prefix = formset.prefix
+        data = {"name": category.name, f"{prefix}-TOTAL_FORMS": 3, f"{prefix}-INITIAL_FORMS": 2,
+                f"{prefix}-MIN_NUM_FORMS": 0, f"{prefix}-MAX_NUM_FORMS": 1000}
+        for i, form in enumerate(formset.initial_forms):
+            data.update({f"{prefix}-{i}-id": form.instance.pk, f"{prefix}-{i}-category": category.pk,
+                         f"{prefix}-{i}-parent": form.instance.parent_id or ""})
+            if form.instance.parent_id is None:
+                root = form.instance
+            else:
+                # the leaf becomes a root
+                data[f"{prefix}-{i}-parent"] = ""
+        data[f"{prefix}-2-parent"] = root.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(302, self.client.post(url, data).status_code)
+        self.assertEqual(2, CategoryMPTT.objects.filter(parent__isnull=True).count())
+        self.assertEqual(2, CategoryMPTT.objects.get(pk=root.pk).child_count)
+        self.assertEqual({}, CategoryMPTT.objects.check_trees())
+
+
+class CategoryMPTTName_TestCase(TestCase):
+    def setUp(self):
+        self.categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 4)])
+
+    def names(self):
+        return dict(CategoryMPTT.objects.values_list("category_id", "name"))
+
+    def test_name_follows_category(self):
+        root = CategoryMPTT.objects.create(category=self.categories[0])
+        CategoryMPTT.objects.create(category=self.categories[1], parent=root)
+        CategoryMPTT.objects.create(category=self.categories[1], parent=root)
+        self.assertEqual({self.categories[0].id: "category_1", self.categories[1].id: "category_2"}, self.names())
+
+        category = self.categories[1]
+        category.name = "renamed"
+        with self.assertNumQueries(2):
+            # the category itself and one UPDATE of its nodes
+            category.save()
+        self.assertEqual("renamed", self.names()[category.id])
+
+        root = CategoryMPTT.objects.get(pk=root.pk)
+        root.category = self.categories[2]
+        root.save()
+        self.assertEqual("category_3", CategoryMPTT.objects.get(pk=root.pk).name)
+        self.assertEqual("category_3", str(root))
+
+    def test_bulk_load_and_backfill(self):
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {}, ids[2]: {}}})
+        expected = {category.id: category.name for category in self.categories}
+        self.assertEqual(expected, self.names())
+        self.assertEqual("category_1", dump_tree()[0]["name"])
+
+        CategoryMPTT.objects.update(name="")
+        call_command("sync_names", batch_size=2, verbosity=0)
+        self.assertEqual(expected, self.names())
+
+    def test_sync_names_changes_the_etag(self):
+        ids = [category.id for category in self.categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {}}})
+        url = reverse("category:dump", args=["mptt"])
+        tree_cache().clear()
+        etag = self.client.get(url).headers["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("sync_names", verbosity=0)
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        Category.objects.filter(pk=ids[1]).update(name="renamed")
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("sync_names", verbosity=0)
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+
+class GetOrNoneManager_TestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 6)])
+
+    def test_get_many_or_none(self):
+        names = ["category_1", "category_3", "missing", "category_5", "category_1"]
+        with self.assertNumQueries(2):
+            found = Category.objects.get_many_or_none("name", names, chunk_size=2)
+        self.assertEqual(["category_1", "category_3", "missing", "category_5"], list(found))
+        self.assertIsNone(found["missing"])
+        self.assertEqual("category_3", found["category_3"].name)
+        with self.assertRaises(ValueError):
+            Category.objects.get_many_or_none("name__iexact", names)
+
+    def test_identity_map(self):
+        with identity_map():
+            with self.assertNumQueries(1):
+                category = Category.objects.get_or_none(name="category_2")
+                self.assertIs(category, Category.objects.get_or_none(name="category_2"))
+                self.assertIs(category, Category.objects.get_or_none(pk=category.pk))
+                self.assertIs(category, Category.objects.get_many_or_none("id", [category.pk])[category.pk])
+            with self.assertNumQueries(1):
+                found = Category.objects.get_many_or_none("name", ["category_2", "category_4"])
+            self.assertIs(category, found["category_2"])
+
+            category.name = "renamed"
+            category.save()
+            with self.assertNumQueries(1):
+                self.assertIsNone(Category.objects.get_or_none(name="category_2"))
+        with self.assertNumQueries(1):
+            Category.objects.get_or_none(name="category_4")
+
+    def test_other_models_keep_fast_deletes(self):
+        self.assertTrue(Collector(using="default").can_fast_delete(CategoryClosure.objects.all()))
+
+
+class CategoryBulkUpsert_TestCase(TestCase):
+    def test_bulk_upsert_is_idempotent(self):
+        existing = Category.objects.create(name="category_2")
+        names = (f"category_{i % 4}" for i in range(10))
+        ids = Category.objects.bulk_upsert(names, batch_size=3)
+        self.assertEqual({f"category_{i}" for i in range(4)}, set(ids))
+        self.assertEqual(existing.pk, ids["category_2"])
+        self.assertEqual(dict(Category.objects.values_list("name", "id")), ids)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(ids, Category.objects.bulk_upsert([f"category_{i}" for i in range(4)]))
+        # existing rows are not rewritten, one INSERT and one SELECT per batch
+        self.assertEqual(2, len(queries))
+        self.assertNotIn("UPDATE", queries[0]["sql"].upper())
+
+    def test_import_categories(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "feed.csv")
+            with open(csv_path, "w") as fp:
+                fp.write("id,name\n1,category_1\n2, category_2 \n3,category_1\n4,\n")
+            jsonl_path = os.path.join(directory, "feed.jsonl.gz")
+            with gzip.open(jsonl_path, "wt") as fp:
+                fp.write('{"name": "category_3"}\n"category_2"\n\n')
+            call_command("import_categories", csv_path, verbosity=0)
+            call_command("import_categories", jsonl_path, verbosity=0)
+            with self.assertRaises(CommandError):
+                call_command("import_categories", csv_path, field="title", verbosity=0)
+            with gzip.open(jsonl_path, "wt") as fp:
+                fp.write('"category_4"\n5\n')
+            with self.assertRaisesMessage(CommandError, "line 2"):
+                call_command("import_categories", jsonl_path, verbosity=0)
+            with open(csv_path, "w") as fp:
+                fp.write("name\ncategory_5\n" + "x" * 257 + "\n")
+            with self.assertRaisesMessage(CommandError, "line 3: name longer than 256 characters"):
+                call_command("import_categories", csv_path, verbosity=0)
+            with open(csv_path, "w") as fp:
+                fp.write("name\ncategory_5\ncategory_6\ncategory_7\n")
+            with mock.patch.object(type(Category.objects), "_upsert_batch", side_effect=DataError("rejected")), \
+                    self.assertRaisesMessage(CommandError, "names up to line 3 was rejected"):
+                call_command("import_categories", csv_path, batch_size=2, verbosity=0)
+        self.assertEqual(["category_1", "category_2", "category_3"],
+                         sorted(Category.objects.values_list("name", flat=True)))
+
+
+class LoadFixture_TestCase(TestCase):
+    def setUp(self):
+        categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 8)])
+        ids = [category.pk for category in categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}, ids[4]: {ids[5]: {}}})
+        root = CategoryTreeBeard.add_root(name="root")
+        root.add_child(name="child")
+        # dumpdata keeps milliseconds only, a round value also tells a kept timestamp from the load time
+        created = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        Category.objects.update(created_at=created)
+        CategoryMPTT.objects.update(created_at=created)
+
+    @staticmethod
+    def rows():
+        return (list(Category.objects.order_by("pk").values_list("pk", "name", "created_at")),
+                list(CategoryMPTT.objects.order_by("pk").values_list(
+                    "pk", "parent_id", "category_id", "name", "tree_id", "lft", "rgt", "level",
+                    "child_count", "descendant_count", "created_at")),
+                list(CategoryTreeBeard.objects.order_by("pk").values_list("pk", "path", "depth", "numchild", "name")))
+
+    def dump(self) -> str:
+        out = io.StringIO()
+        call_command("dumpdata", "category.Category", "category.CategoryMPTT", "category.CategoryTreeBeard",
+                     stdout=out)
+        return out.getvalue()
+
+    def test_iter_fixture(self):
+        objects = [{"model": "a.b", "pk": i, "fields": {"name": "x" + str(i) + "], ,{", "n": [i, 1.5]}}
+                   for i in range(5)]
+        for text in (json.dumps(objects, indent=2), "\n".join(map(json.dumps, objects)) + "\n", json.dumps(objects)):
+            self.assertEqual(objects, list(iter_fixture(io.StringIO(text), chunk_size=7)))
+        self.assertEqual([], list(iter_fixture(io.StringIO(" [ ] "))))
+        self.assertEqual([], list(iter_fixture(io.StringIO(""))))
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_fixture(io.StringIO('[{"model": "a.b"}, {"mod'), chunk_size=4))
+
+    def test_round_trip(self):
+        expected, fixture = self.rows(), self.dump()
+        CategoryMPTT.objects.all().delete()
+        CategoryTreeBeard.objects.all().delete()
+        Category.objects.all().delete()
+        self.assertEqual(15, load_fixture(io.StringIO(fixture), batch_size=2))
+        self.assertEqual(expected, self.rows())
+        self.assertEqual(["category_1", "category_2", "category_3"],
+                         [str(node) for node in CategoryMPTT.objects.get(lft=1, name="category_1")
+                         .get_descendants(include_self=True)[:3]])
+
+    def test_overwrites_and_repairs(self):
+        objects = json.loads(self.dump())
+        for obj in objects:
+            if obj["model"] == "category.category" and obj["fields"]["name"] == "category_1":
+                obj["fields"]["name"] = "renamed"
+            if obj["model"] == "category.categorymptt":
+                obj["fields"]["lft"] *= 10
+                obj["fields"]["rgt"] *= 10
+        self.assertEqual(15, load_fixture(objects))
+        self.assertEqual(7, Category.objects.count())
+        self.assertTrue(CategoryMPTT.objects.filter(name="renamed").exists())
+        self.assertFalse(CategoryMPTT.objects.check_trees())
+
+    def test_counters_missing_from_the_fixture(self):
+        expected = set(CategoryMPTT.objects.values_list("pk", "child_count", "descendant_count"))
+        objects = json.loads(self.dump())
+        CategoryMPTT.objects.all().delete()
+        for obj in objects:
+            if obj["model"] == "category.categorymptt":
+                del obj["fields"]["child_count"], obj["fields"]["descendant_count"]
+        load_fixture(objects)
+        self.assertEqual(expected, set(CategoryMPTT.objects.values_list("pk", "child_count", "descendant_count")))
+
+    def test_natural_keys_of_buffered_objects(self):
+        objects = [
+            {"model": "contenttypes.contenttype", "fields": {"app_label": "extra", "model": "thing"}},
+            {"model": "auth.permission", "fields": {"name": "Can do", "codename": "do_thing",
+                                                    "content_type": ["extra", "thing"]}},
+            {"model": "auth.group", "fields": {"name": "editors", "permissions": [
+                ["add_category", "category", "category"], ["do_thing", "extra", "thing"]]}},
+            {"model": "auth.user", "fields": {"username": "editor", "password": "!", "groups": [["editors"]]}},
+        ]
+        self.assertEqual(4, load_fixture(objects, batch_size=10))
+        user = get_user_model().objects.get(username="editor")
+        self.assertEqual(["editors"], [group.name for group in user.groups.all()])
+        self.assertTrue(user.has_perm("category.add_category"))
+        self.assertTrue(user.has_perm("extra.do_thing"))
+        with self.assertRaises(DeserializationError):
+            load_fixture([{"model": "auth.user", "fields": {"username": "other", "groups": [["missing"]]}}])
+
+
+class TreeTransfer_TestCase(TestCase):
+    def setUp(self):
+        categories = Category.objects.bulk_create([Category(name=f"category_{i}") for i in range(1, 6)])
+        ids = [category.pk for category in categories]
+        CategoryMPTT.objects.bulk_load_tree({ids[0]: {ids[1]: {ids[2]: {}}, ids[3]: {}}, ids[4]: {}})
+
+    @staticmethod
+    def rows():
+        return (list(Category.objects.order_by("pk").values_list("pk", "name", "created_at")),
+                list(CategoryMPTT.objects.order_by("pk").values_list(
+                    "pk", "parent_id", "category_id", "name", "tree_id", "lft", "rgt", "level",
+                    "child_count", "descendant_count", "created_at")))
+
+    def test_export_import_round_trip(self):
+        # texts that look like the NULL marker
+        Category.objects.filter(pk=1).update(name="\\N")
+        Category.objects.filter(pk=2).update(name="\\\\N")
+        CategoryMPTT.objects.sync_names()
+        expected = self.rows()
+        with tempfile.TemporaryDirectory() as directory:
+            call_command("export_tree", directory, verbosity=0)
+            call_command("import_tree", directory, replace=True, batch_size=2, verbosity=0)
+            with self.assertRaises(CommandError):
+                # the rows are there already
+                call_command("import_tree", directory, verbosity=0)
+        self.assertEqual(expected, self.rows())
+        self.assertEqual(6, Category.objects.create(name="category_6").pk)
+
+    @override_settings(CATEGORY_CLOSURE_ENABLED=True)
+    def test_import_nested_sets_only(self):
+        """a dump with just the columns of the SQLAlchemy example, names and counts are derived"""
+        with tempfile.TemporaryDirectory() as directory:
+            call_command("export_tree", directory, verbosity=0)
+            path = table_path(directory, CategoryMPTT)
+            with gzip.open(path, "wt", newline="") as fp:
+                # the roots of sqlalchemy-mptt are on level 1
+                fp.write("id,parent_id,category_id,tree_id,lft,rgt,level,extra\n"
+                         "1,\\N,1,1,1,6,1,x\n2,1,2,1,2,3,2,x\n3,1,3,1,4,5,2,x\n")
+            with mock.patch.object(CategoryMPTTManager, "repair_trees") as repair_trees:
+                call_command("import_tree", directory, replace=True, verbosity=0)
+        self.assertFalse(repair_trees.called)
+        self.assertEqual([0, 1, 1], list(CategoryMPTT.objects.order_by("pk").values_list("level", flat=True)))
+        root = CategoryMPTT.objects.get(pk=1)
+        self.assertEqual(("category_1", 2, 2), (root.name, root.child_count, root.descendant_count))
+        self.assertEqual(3, CategoryClosure.objects.filter(ancestor=root).count())
+        self.assertFalse(CategoryMPTT.objects.check_trees())
+
+
+class BulkCopy_TestCase(TestCase):
+    def test_copy_objects(self):
+        Category.objects.create(name="category_1")
+        ids = allocate_ids(Category, 3)
+        self.assertEqual(3, len(set(ids)))
+        categories = (Category(pk=pk, name=f"category_{pk}") for pk in ids)
+        with self.assertNumQueries(2):
+            self.assertEqual(3, copy_objects(Category, categories, batch_size=2))
+        self.assertEqual(4, Category.objects.filter(created_at__isnull=False).count())
+        self.assertEqual(ids[-1] + 1, allocate_ids(Category, 1)[0])
+        with self.assertRaises(ValueError):
+            copy_objects(Category, [Category(name="no pk")])
+
+    def test_copy_rows(self):
+        category = Category.objects.create(name="category_1")
+        rows = ((pk, category.pk, 0, 1, 2, pk, "", 0, 0, category.created_at, category.created_at)
+                for pk in (1, 2))
+        columns = ["id", "category_id", "level", "lft", "rgt", "tree_id", "name", "child_count",
+                   "descendant_count", "created_at", "updated_at"]
+        self.assertEqual(2, copy_rows(CategoryMPTT, columns, rows))
+        self.assertEqual([1, 2], list(CategoryMPTT.objects.order_by("tree_id").values_list("tree_id", flat=True)))
+
+    def test_copy_text(self):
+        self.assertTrue(copy_supported(CategoryMPTT))
+        self.assertTrue(copy_supported(get_user_model(), ["id", "username", "is_staff", "last_login"]))
+        moment = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+        row = [None, "\\N", "a\tb\nc\rd\\", True, False, 3, moment]
+        self.assertEqual(["\\N", "\\\\N", "a\\tb\\nc\\rd\\\\", "t", "f", "3", "2020-01-02T03:04:05+00:00"],
+                         list(map(_copy_text, row)))
+
+
+class TreeBench_TestCase(TestCase):
+    def test_report(self):
+        out = io.StringIO()
+        call_command("tree_bench", depth=1, fanout=3, samples=2, json_path="-", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual({"depth": 1, "fanout": 3, "samples": 2},
+                         {key: report[key] for key in ("depth", "fanout", "samples")})
+        self.assertEqual({"mptt", "treebeard"}, set(report["results"]))
+        for results in report["results"].values():
+            self.assertEqual(4, results["nodes"])
+            self.assertEqual(set(OPERATIONS), set(results) - {"nodes"})
+            for operation in OPERATIONS:
+                self.assertEqual({"seconds", "queries"}, set(results[operation]))
+        # identical workloads: the categories of the nested sets are created outside of the timed insert
+        self.assertFalse(Category.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command("tree_bench", samples=0, stdout=out)
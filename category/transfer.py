@@ -0,0 +1,165 @@
+"""
+Columnar export and import of the nested-set tables, shared with sqlalchemy-mptt-exmpl.
+
+A dump is a directory with one gzipped CSV file per table, named after the table
+(``category_category.csv.gz``, ``category_category_mptt.csv.gz``): the column names in the
+header row, one row per record in primary key order, ``\\N`` for NULL. A text that consists of
+backslashes and an ``N`` gets one more leading backslash, so ``\\N`` stays NULL and the text
+``\\N`` is written as ``\\\\N``. The rows are streamed with ``COPY`` on PostgreSQL and with
+batched ``executemany`` elsewhere (``category.bulk``), never through the ORM.
+
+The import keeps the columns it knows and ignores the others. Columns missing from a file get
+their defaults (``auto_now`` timestamps the import time); the denormalized ``name``,
+``child_count`` and ``descendant_count`` and the closure are recomputed afterwards, so a dump
+written by the SQLAlchemy example only needs the nested-set columns. Its roots are on level 1,
+the levels of a file are shifted so that its first root is on level 0.
+"""
+import csv
+import gzip
+import os
+import re
+from typing import Dict, Iterable, List, Tuple
+
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from category.bulk import NULL, copy_rows
+from category.instrumentation import traced
+from category.loading import finish_trees
+from category.locks import tree_lock
+from category.models import Category, CategoryClosure, CategoryMPTT
+
+MODELS = (Category, CategoryMPTT)
+
+# texts that look like the NULL marker, written with one more leading backslash
+_ESCAPED = re.compile(r"\\+N")
+
+
+def table_path(directory: str, model) -> str:
+    return os.path.join(directory, f"{model._meta.db_table}.csv.gz")
+
+
+def _quoted(names: Iterable[str]) -> str:
+    return ", ".join(connection.ops.quote_name(name) for name in names)
+
+
+def _escape(value):
+    return "\\" + value if isinstance(value, str) and _ESCAPED.fullmatch(value) else value
+
+
+def _unescape(value: str) -> str:
+    return value[1:] if _ESCAPED.fullmatch(value) else value
+
+
+def _is_text(field) -> bool:
+    return isinstance(field, (models.CharField, models.TextField))
+
+
+def _export_table(model, path: str, chunk_size: int) -> int:
+    fields = model._meta.concrete_fields
+    columns = [field.column for field in fields]
+    table = connection.ops.quote_name(model._meta.db_table)
+    order = connection.ops.quote_name(model._meta.pk.column)
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as fp, connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            selected = ", ".join(
+                f"CASE WHEN {column} ~ '^\\\\+N$' THEN '\\' || {column} ELSE {column} END AS {column}"
+                if _is_text(field) else column
+                for field, column in zip(fields, map(connection.ops.quote_name, columns))
+            )
+            cursor.cursor.copy_expert(
+                f"COPY (SELECT {selected} FROM {table} ORDER BY {order}) "
+                f"TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{NULL}')", fp)
+            return cursor.cursor.rowcount
+        writer = csv.writer(fp)
+        writer.writerow(columns)
+        cursor.execute(f"SELECT {_quoted(columns)} FROM {table} ORDER BY {order}")
+        count = 0
+        while rows := cursor.fetchmany(chunk_size):
+            writer.writerows([NULL if value is None else _escape(value) for value in row] for row in rows)
+            count += len(rows)
+        return count
+
+
+@traced("export_tree")
+def export_tree(directory: str, chunk_size: int = 10000) -> Dict[str, int]:
+    """writes all ``MODELS`` tables to ``directory`` from one snapshot, returns the rows per table"""
+    os.makedirs(directory, exist_ok=True)
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        return {model._meta.db_table: _export_table(model, table_path(directory, model), chunk_size)
+                for model in MODELS}
+
+
+def _root_level(path: str) -> int:
+    """the level of the first root in a file of the nested-set table, 0 without roots or levels"""
+    opts = CategoryMPTT._mptt_meta
+    parent_column = CategoryMPTT._meta.get_field(opts.parent_attr).column
+    level_column = CategoryMPTT._meta.get_field(opts.level_attr).column
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as fp:
+        for row in csv.DictReader(fp):
+            if row.get(level_column) is None:
+                return 0
+            if row.get(parent_column) in (NULL, ""):
+                return int(row[level_column])
+    return 0
+
+
+def _import_table(model, path: str, batch_size: int) -> Tuple[int, List[str]]:
+    """loads one file, returns the number of rows and the columns it provided"""
+    fields = {field.column: field for field in model._meta.concrete_fields}
+    now = timezone.now()
+    shift = _root_level(path) if model is CategoryMPTT else 0
+    level_column = model._meta.get_field(model._mptt_meta.level_attr).column if shift else None
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as fp:
+        reader = csv.reader(fp)
+        header = next(reader, [])
+        known = [(index, fields[column]) for index, column in enumerate(header) if column in fields]
+        provided = [field.column for _index, field in known]
+        defaults = {}
+        for column, field in fields.items():
+            if column in provided:
+                continue
+            if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+                value = now
+            elif field.has_default() or field.null:
+                value = field.get_default()
+            else:
+                raise ValueError(f"{path}: required column {column} is missing")
+            defaults[column] = field.get_db_prep_save(value, connection)
+
+        def value(text: str, field):
+            if text == NULL or (field.null and text == ""):
+                return None
+            if field.column == level_column:
+                return int(text) - shift
+            return _unescape(text) if _is_text(field) else text
+
+        fill = tuple(defaults.values())
+        rows = (tuple(value(row[index], field) for index, field in known) + fill for row in reader)
+        return copy_rows(model, provided + list(defaults), rows, batch_size), provided
+
+
+@traced("import_tree")
+def import_tree(directory: str, replace: bool = False, batch_size: int = 10000) -> Dict[str, int]:
+    """
+    Loads a dump written by ``export_tree()`` (or the SQLAlchemy example) in one transaction
+    under the forest lock and returns the rows per table. ``replace`` empties the tables first,
+    otherwise the rows must not collide with existing ones.
+    """
+    with tree_lock(CategoryMPTT):
+        with connection.cursor() as cursor:
+            if replace:
+                for model in (CategoryClosure, CategoryMPTT, Category):
+                    cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)}")
+            imported = {model: _import_table(model, table_path(directory, model), batch_size) for model in MODELS}
+            for sql in connection.ops.sequence_reset_sql(no_style(), list(MODELS)):
+                cursor.execute(sql)
+        if not {"child_count", "descendant_count"} <= set(imported[CategoryMPTT][1]):
+            call_command("rebuild_counts", verbosity=0)
+        finish_trees({CategoryMPTT})
+    return {model._meta.db_table: count for model, (count, _columns) in imported.items()}
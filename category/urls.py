@@ -0,0 +1,12 @@
+from django.urls import path
+
+from category import views
+
+app_name = "category"
+
+urlpatterns = [
+    path("<str:tree>/dump/", views.dump, name="dump"),
+    path("<str:tree>/<int:pk>/subtree/", views.subtree, name="subtree"),
+    path("<str:tree>/<int:pk>/ancestors/", views.ancestors, name="ancestors"),
+    path("<str:tree>/<int:pk>/children/", views.children, name="children"),
+]
@@ -0,0 +1,135 @@
+"""
+Version counters for category trees, used for ETags and per-version response caching.
+
+Every tree model has an *epoch* and a version per tree (``tree_key``: ``tree_id`` for nested
+sets, the root path segment for materialized paths) plus one for the whole model (``ALL_TREES``).
+Writes to a single tree bump that tree and ``ALL_TREES``; structural changes that can renumber
+other trees (moves, new roots, bulk loads) bump the epoch, which orphans every version of the
+model at once. Versions are time based, so a cleared cache never reuses an old ETag.
+
+Bumps take effect when the writing transaction commits: a reader that sees the new version
+also sees the new rows. Versions and cached bodies have to be shared by all workers, so a
+process-local cache backend disables the ETags and the response cache (``category.W001``)
+unless ``CATEGORY_TREE_CACHE_SINGLE_PROCESS`` declares a single process (``runserver``).
+"""
+import time
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Max
+
+ALL_TREES = "*"
+
+# backends that keep their entries in the process (or nowhere)
+LOCAL_CACHE_BACKENDS = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+class TreeVersion(NamedTuple):
+    etag: str
+    last_modified: float  # unix timestamp
+
+
+def _tree_cache_alias() -> str:
+    return getattr(settings, "CATEGORY_TREE_CACHE", "default")
+
+
+def tree_cache():
+    return caches[_tree_cache_alias()]
+
+
+def versioning_enabled() -> bool:
+    """whether the tree versions can be trusted, i.e. every worker sees the same cache"""
+    backend = settings.CACHES.get(_tree_cache_alias(), {}).get("BACKEND")
+    return backend not in LOCAL_CACHE_BACKENDS or getattr(settings, "CATEGORY_TREE_CACHE_SINGLE_PROCESS", False)
+
+
+@checks.register(checks.Tags.caches)
+def check_tree_cache(app_configs, **kwargs):
+    if versioning_enabled():
+        return []
+    return [checks.Warning(
+        f"The tree cache '{_tree_cache_alias()}' is local to each process, tree ETags and cached "
+        f"tree responses are disabled.",
+        hint="Configure a shared CACHES backend (Redis, Memcached, database) or set "
+             "CATEGORY_TREE_CACHE_SINGLE_PROCESS = True when a single process serves the site.",
+        id="category.W001",
+    )]
+
+
+def _new_version() -> int:
+    return time.time_ns() // 1000
+
+
+def _label(model) -> str:
+    return model._meta.label_lower
+
+
+def _epoch(model) -> int:
+    cache = tree_cache()
+    key = f"category:tree-epoch:{_label(model)}"
+    epoch = cache.get(key)
+    if epoch is None:
+        cache.add(key, _new_version(), timeout=None)
+        epoch = cache.get(key)
+    return epoch
+
+
+def get_tree_version(model, tree_key=ALL_TREES) -> TreeVersion:
+    """
+    Current version of one tree of ``model``. Last-Modified is taken from ``updated_at``
+    (``CreateUpdateTracker``) the first time a version is seen and from the bump time afterwards.
+    """
+    cache = tree_cache()
+    epoch = _epoch(model)
+    key = f"category:tree-version:{_label(model)}:{epoch}:{tree_key}"
+    entry = cache.get(key)
+    if entry is None:
+        queryset = model._default_manager.all()
+        if tree_key != ALL_TREES:
+            queryset = queryset.filter(**{model.tree_key_lookup: tree_key})
+        last = queryset.aggregate(last=Max("updated_at"))["last"]
+        # deletes leave no updated_at behind, the epoch is the latest structural change
+        last_modified = max(last.timestamp() if last else 0, epoch / 1e6)
+        cache.add(key, (_new_version(), last_modified), timeout=None)
+        entry = cache.get(key)
+    version, last_modified = entry
+    return TreeVersion(f'"{_label(model)}-{epoch}-{tree_key}-{version}"', last_modified)
+
+
+def bump_tree_version(model, tree_key=None, using=None):
+    """
+    marks ``tree_key`` (and ``ALL_TREES``) as changed, ``None`` bumps the epoch of the model,
+    once the current transaction of ``using`` commits (at once outside of a transaction)
+    """
+    transaction.on_commit(lambda: _bump(model, tree_key), using=using)
+
+
+def _bump(model, tree_key):
+    cache = tree_cache()
+    if tree_key is None:
+        cache.set(f"category:tree-epoch:{_label(model)}", _new_version(), timeout=None)
+        return
+    epoch = _epoch(model)
+    entry = (_new_version(), time.time())
+    for key in (tree_key, ALL_TREES):
+        cache.set(f"category:tree-version:{_label(model)}:{epoch}:{key}", entry, timeout=None)
+
+
+def node_tree_key(model, pk) -> Optional[object]:
+    """tree key of node ``pk``, cached until the next epoch, ``None`` if the node does not exist"""
+    cache = tree_cache()
+    key = f"category:tree-node:{_label(model)}:{_epoch(model)}:{pk}"
+    tree_key = cache.get(key)
+    if tree_key is None:
+        node = model._default_manager.filter(pk=pk).only(model.tree_key_field).first()
+        if node is None:
+            return None
+        tree_key = node.tree_key
+        cache.set(key, tree_key, timeout=None)
+    return tree_key
@@ -1,3 +1,218 @@
-from django.shortcuts import render
+import hashlib
+from functools import wraps
+from typing import Optional
 
-# Create your views here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from category import versioning
+from category.dump import iter_tree_json
+from category.instrumentation import tree_span
+from category.models import CategoryMPTT, CategoryTreeBeard
+
+
+def serialize_mptt(node: CategoryMPTT) -> dict:
+    return {
+        "id": node.pk,
+        "parent_id": node.parent_id,
+        "category_id": node.category_id,
+        "name": node.name,
+        "level": node.level,
+        "child_count": node.child_count,
+        "descendant_count": node.descendant_count,
+    }
+
+
+def serialize_treebeard(node: CategoryTreeBeard) -> dict:
+    return {
+        "id": node.pk,
+        "name": node.name,
+        "path": node.path,
+        "depth": node.depth,
+        "numchild": node.numchild,
+    }
+
+
+# tree URL segment -> (model, serializer, relations to join)
+TREES = {
+    "mptt": (CategoryMPTT, serialize_mptt, ()),
+    "treebeard": (CategoryTreeBeard, serialize_treebeard, ()),
+}
+
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, "CATEGORY_TREE_CACHE_TIMEOUT", 3600)
+
+
+def _root_id(request) -> Optional[int]:
+    """``?root=`` as a primary key, ``None`` without it, ValueError for anything but a bigint"""
+    root = request.GET.get("root")
+    if not root:
+        return None
+    root = int(root)
+    if not 0 < root < 1 << 63:
+        raise ValueError(f"root out of range: {root}")
+    return root
+
+
+def _tree_version(tree: str, pk):
+    """the version of the tree the view reads, ``None`` lets the view answer 404"""
+    if tree not in TREES:
+        return None
+    model = TREES[tree][0]
+    if pk is None:
+        return versioning.get_tree_version(model)
+    tree_key = versioning.node_tree_key(model, pk)
+    return None if tree_key is None else versioning.get_tree_version(model, tree_key)
+
+
+def _cached_response(request, version: versioning.TreeVersion, cache_key: str):
+    """304 for a matching conditional request, else the cached body of this version (or None)"""
+    response = get_conditional_response(request, etag=version.etag, last_modified=int(version.last_modified))
+    if response is None:
+        entry = versioning.tree_cache().get(cache_key)
+        if entry is None:
+            return None
+        content_type, content = entry
+        response = HttpResponse(content, content_type=content_type)
+    return _set_validators(response, version)
+
+
+def _set_validators(response, version: versioning.TreeVersion):
+    response.headers["ETag"] = quote_etag(version.etag)
+    response.headers["Last-Modified"] = http_date(version.last_modified)
+    return response
+
+
+def _store_response(response, version: versioning.TreeVersion, cache_key: str):
+    _set_validators(response, version)
+    if response.status_code != 200:
+        return response
+    cache = versioning.tree_cache()
+    content_type = response.headers["Content-Type"]
+    if not response.streaming:
+        cache.set(cache_key, (content_type, response.content), RESPONSE_CACHE_TIMEOUT)
+        return response
+
+    def tee(chunks):
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        cache.set(cache_key, (content_type, b"".join(parts)), RESPONSE_CACHE_TIMEOUT)
+
+    response.streaming_content = tee(response.streaming_content)
+    return response
+
+
+def versioned(*params: str):
+    """
+    Strong ETag and Last-Modified from the tree version (see ``category.versioning``),
+    304 for conditional requests and one cached response body per version, path and value of
+    the query ``params`` the view reads; other query parameters cannot add cache entries.
+    A hit on either never touches the database. A no-op with a process-local cache.
+    """
+
+    def decorator(view):
+        def prepare(request, tree, pk):
+            if request.method not in ("GET", "HEAD") or not versioning.versioning_enabled():
+                return None, None, None
+            try:
+                version = _tree_version(tree, pk if pk is not None else _root_id(request))
+            except ValueError:
+                # the view answers 400
+                return None, None, None
+            if version is None:
+                return None, None, None
+            query = [(name, request.GET.get(name)) for name in params]
+            cache_key = "category:tree-response:" + hashlib.sha1(
+                f"{version.etag}:{request.path}:{query!r}".encode()).hexdigest()
+            return version, cache_key, _cached_response(request, version, cache_key)
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, tree, pk=None, **kwargs):
+                version, cache_key, response = await sync_to_async(prepare)(request, tree, pk)
+                if response is not None:
+                    return response
+                response = await view(request, tree, **({"pk": pk} if pk is not None else {}), **kwargs)
+                if version is None:
+                    return response
+                return await sync_to_async(_store_response)(response, version, cache_key)
+        else:
+            @wraps(view)
+            def wrapper(request, tree, pk=None, **kwargs):
+                version, cache_key, response = prepare(request, tree, pk)
+                if response is not None:
+                    return response
+                response = view(request, tree, **({"pk": pk} if pk is not None else {}), **kwargs)
+                if version is None:
+                    return response
+                return _store_response(response, version, cache_key)
+        return wrapper
+
+    return decorator
+
+
+async def _get_node(tree: str, pk: int):
+    try:
+        model, serializer, related = TREES[tree]
+    except KeyError:
+        raise Http404(f"Unknown tree: {tree}")
+    try:
+        node = await model.objects.select_related(*related).aget(pk=pk)
+    except model.DoesNotExist:
+        raise Http404(f"No {model._meta.verbose_name} matches the given query.")
+    return node, serializer, related
+
+
+async def _tree_response(span: str, node, queryset, serializer, related) -> JsonResponse:
+    if related:
+        queryset = queryset.select_related(*related)
+    with tree_span(span):
+        results = [serializer(item) async for item in queryset.aiterator()]
+    return JsonResponse({"node": serializer(node), "results": results})
+
+
+@versioned()
+async def subtree(request, tree: str, pk: int):
+    """the node's descendants in tree order"""
+    node, serializer, related = await _get_node(tree, pk)
+    return await _tree_response(f"{tree}.get_descendants", node, node.get_descendants(), serializer, related)
+
+
+@versioned()
+async def ancestors(request, tree: str, pk: int):
+    """the node's ancestors from the root down"""
+    node, serializer, related = await _get_node(tree, pk)
+    return await _tree_response(f"{tree}.get_ancestors", node, node.get_ancestors(), serializer, related)
+
+
+@versioned()
+async def children(request, tree: str, pk: int):
+    """the node's direct children"""
+    node, serializer, related = await _get_node(tree, pk)
+    return await _tree_response(f"{tree}.get_children", node, node.get_children(), serializer, related)
+
+
+@versioned("root", "max_depth")
+def dump(request, tree: str):
+    """
+    The whole forest (or ``?root=<pk>``) as nested JSON, streamed from a single query.
+    ``?max_depth=<n>`` limits the levels below the root.
+    """
+    if tree not in TREES:
+        raise Http404(f"Unknown tree: {tree}")
+    model = TREES[tree][0]
+    try:
+        root_id = _root_id(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid root")
+    root = get_object_or_404(model, pk=root_id) if root_id is not None else None
+    max_depth = request.GET.get("max_depth")
+    max_depth = int(max_depth) if max_depth and max_depth.isdigit() else None
+    return StreamingHttpResponse(iter_tree_json(root, max_depth=max_depth, model=model),
+                                 content_type="application/json")
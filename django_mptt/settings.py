@@ -56,6 +56,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Query counts, SQL time and tree operation spans per request, see CATEGORY_METRICS below
+    'category.instrumentation.TreeMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     # Request and all middleware that come after our middleware, would be profiled
@@ -64,6 +66,8 @@ MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Uncomment the following line to reuse Category lookups within a request (GetOrNoneManager)
+    # 'category.identity.IdentityMapMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -135,6 +139,36 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Tree versions and cached tree responses (category.versioning) have to be shared by all
+# workers: point CACHE_BACKEND/CACHE_LOCATION at Redis, Memcached or the database cache.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    },
+}
+# A process-local cache is only correct when one process serves the site (runserver), else the
+# tree ETags and response cache are switched off (system check category.W001).
+CATEGORY_TREE_CACHE_SINGLE_PROCESS = os.getenv(
+    'CATEGORY_TREE_CACHE_SINGLE_PROCESS', str(DEBUG)).lower() in ('1', 'true', 'yes')
+
+# Sink for category.instrumentation.TreeMetricsMiddleware: LogSink (default), StatsdSink or RingBufferSink
+CATEGORY_METRICS = {
+    'SINK': os.getenv('CATEGORY_METRICS_SINK', 'category.instrumentation.LogSink'),
+}
+
+# Keep the CategoryClosure (ancestor, descendant, depth) projection of CategoryMPTT in sync.
+# Run `manage.py rebuild_closure` after switching it on.
+CATEGORY_CLOSURE_ENABLED = os.getenv('CATEGORY_CLOSURE_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# Query CategoryTreeBeard descendants/ancestors through the ltree column (PostgreSQL only).
+# Run `manage.py enable_ltree` first.
+CATEGORY_TREEBEARD_LTREE = os.getenv('CATEGORY_TREEBEARD_LTREE', '').lower() in ('1', 'true', 'yes')
+
+# Sparse nested sets for CategoryMPTT: free lft/rgt values left between neighbours so that
+# most inserts take a free slot instead of shifting the tree (0 = dense, django-mptt's default).
+CATEGORY_MPTT_GAP = int(os.getenv('CATEGORY_MPTT_GAP', '0'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -156,5 +190,9 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'WARNING'),
         },
+        'category.instrumentation': {
+            'handlers': ['console'],
+            'level': os.getenv('CATEGORY_METRICS_LOG_LEVEL', 'WARNING'),
+        },
     },
 }
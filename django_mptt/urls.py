@@ -20,6 +20,7 @@ from django.conf import settings
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/categories/', include('category.urls')),
     path('', RedirectView.as_view(url='admin/', permanent=True), name='admin'),
 ]
 